@@ -0,0 +1,146 @@
+"""Admission control: turn excess requests away quickly instead of queueing them.
+
+Routes are grouped into classes by cost. Each class has a limit on requests handled
+at once, beyond which requests get a 503, and a token bucket per client address,
+beyond which they get a 429. Both carry a Retry-After. Password hashing and large
+reads are limited on their own, so a spike in either can't slow every other route.
+Limits apply per worker process, like the metrics.
+"""
+
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+from config.config import settings
+from fastapi import status
+from fastapi.responses import JSONResponse
+from metrics import metrics
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+@dataclass
+class RouteClass:
+    name: str
+    concurrency: int  # Requests handled at once, 0 for no limit
+    rate: float  # Requests per second each client may sustain
+    burst: int  # Requests a client may make at once after being idle
+    in_progress: int = 0
+
+
+HASHING = RouteClass(
+    "hashing",
+    settings.hashing_concurrency,
+    settings.hashing_rate,
+    settings.hashing_burst,
+)
+BULK = RouteClass(
+    "bulk", settings.bulk_concurrency, settings.bulk_rate, settings.bulk_burst
+)
+# Streams stay open for as long as clients listen, so only how often they connect
+# is limited
+STREAM = RouteClass("stream", 0, settings.request_rate, settings.request_burst)
+DEFAULT = RouteClass(
+    "default",
+    settings.request_concurrency,
+    settings.request_rate,
+    settings.request_burst,
+)
+
+ROUTE_CLASSES: Dict[Tuple[str, str], RouteClass] = {
+    ("POST", "/token"): HASHING,
+    ("POST", "/user/new"): HASHING,
+    ("POST", "/user/password/edit"): HASHING,
+    ("GET", "/event"): BULK,
+    ("GET", "/event/export.ics"): BULK,
+    ("POST", "/event/import.ics"): BULK,
+    ("POST", "/event/batch"): BULK,
+    ("POST", "/freebusy"): BULK,
+    ("GET", "/event/stream"): STREAM,
+}
+
+# Health checks and scrapes must get through precisely when the API is overloaded
+EXEMPT = {("GET", "/ping"), ("GET", "/metrics")}
+
+
+class TokenBuckets:
+    """A token bucket per key, forgetting the least recently seen beyond max_size.
+
+    A forgotten client starts again with a full bucket, as if it had been idle.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._buckets: OrderedDict[Tuple[str, str], Tuple[float, float]] = OrderedDict()
+
+    def take(self, key: Tuple[str, str], rate: float, burst: int) -> float:
+        """Take a token, returning 0 or else the seconds until one will be available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+buckets = TokenBuckets(settings.rate_limit_clients)
+
+
+class AdmissionMiddleware:
+    """Reject requests over their route class's concurrency or per-client rate.
+
+    Add it before CORSMiddleware, so that rejections still carry CORS headers and
+    browsers can read their Retry-After.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (scope["method"], scope["path"]) in EXEMPT:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = ROUTE_CLASSES.get((scope["method"], scope["path"]), DEFAULT)
+        if settings.rate_limits:
+            # Behind a proxy listed in forwarded_allow_ips, uvicorn has already put
+            # the original client's address here; otherwise it is the proxy's
+            client = scope["client"][0] if scope.get("client") else ""
+            wait = buckets.take(
+                (route_class.name, client), route_class.rate, route_class.burst
+            )
+            if wait:
+                metrics.record_rejection(route_class.name, "rate")
+                response = JSONResponse(
+                    {"detail": "Too many requests, slow down"},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": str(math.ceil(wait))},
+                )
+                await response(scope, receive, send)
+                return
+
+        if (
+            route_class.concurrency
+            and route_class.in_progress >= route_class.concurrency
+        ):
+            metrics.record_rejection(route_class.name, "concurrency")
+            response = JSONResponse(
+                {"detail": "Server busy, try again shortly"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(settings.busy_retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        route_class.in_progress += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.in_progress -= 1
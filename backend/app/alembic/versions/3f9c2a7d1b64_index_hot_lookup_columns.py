@@ -0,0 +1,171 @@
+"""Bring the baseline schema up to date and index hot lookup columns
+
+Databases from before Alembic have only users, events and user_event_association,
+as the models' create_all used to make them; an empty one gets those first. Then
+the columns and tables added since are created where missing: users.calendar_version,
+events.recurrence and events.series_end (backfilled from "end", since every existing
+event is a single one), occurrence_overrides and calendar_changes.
+
+After that, unique indexes on users.username and users.email, which are looked up on every login
+and availability check, and indexes on the foreign keys and event times that the
+calendar queries filter on. Databases created by create_all since these were declared
+on the models already have them, so every index is created only if missing.
+
+The unique indexes can't be built while duplicate usernames or emails exist; resolve
+those first. Indexes are built concurrently so the tables stay writable meanwhile.
+
+Revision ID: 3f9c2a7d1b64
+Revises:
+Create Date: 2026-10-18 10:12:41.503317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f9c2a7d1b64"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ("ix_users_username", "users", ["username"], {"unique": True}),
+    ("ix_users_email", "users", ["email"], {"unique": True}),
+    ("ix_events_owner_id", "events", ["owner_id"], {}),
+    ("ix_events_start_end", "events", ["start", "end"], {}),
+    (
+        "ix_events_span",
+        "events",
+        [sa.text("int4range(least(start, series_end), series_end)")],
+        {"postgresql_using": "gist"},
+    ),
+    (
+        "ix_user_event_association_event_id",
+        "user_event_association",
+        ["event_id"],
+        {},
+    ),
+    ("ix_calendar_changes_changed_at", "calendar_changes", ["changed_at"], {}),
+]
+
+
+def create_baseline_tables() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+        sa.Column("username", sa.String(20), nullable=False),
+        sa.Column("email", sa.String(254), nullable=False),
+        sa.Column("password_hash", sa.String(), nullable=False),
+    )
+    op.create_table(
+        "events",
+        sa.Column("id", postgresql.UUID(as_uuid=True), primary_key=True),
+        sa.Column("title", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=False),
+        sa.Column("start", sa.Integer(), nullable=False),
+        sa.Column("end", sa.Integer(), nullable=False),
+        sa.Column(
+            "owner_id",
+            postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("users.id", ondelete="cascade"),
+            nullable=False,
+        ),
+    )
+    op.create_table(
+        "user_event_association",
+        sa.Column(
+            "user_id",
+            postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("users.id", ondelete="cascade"),
+            primary_key=True,
+        ),
+        sa.Column(
+            "event_id",
+            postgresql.UUID(as_uuid=True),
+            sa.ForeignKey("events.id", ondelete="cascade"),
+            primary_key=True,
+        ),
+    )
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("users"):
+        create_baseline_tables()
+        inspector = sa.inspect(op.get_bind())
+
+    if "calendar_version" not in {
+        column["name"] for column in inspector.get_columns("users")
+    }:
+        op.add_column(
+            "users",
+            sa.Column(
+                "calendar_version", sa.Integer(), nullable=False, server_default="0"
+            ),
+        )
+    event_columns = {column["name"] for column in inspector.get_columns("events")}
+    if "recurrence" not in event_columns:
+        op.add_column("events", sa.Column("recurrence", sa.String(), nullable=True))
+    if "series_end" not in event_columns:
+        op.add_column("events", sa.Column("series_end", sa.Integer(), nullable=True))
+        op.execute('UPDATE events SET series_end = "end"')
+
+    if not inspector.has_table("occurrence_overrides"):
+        op.create_table(
+            "occurrence_overrides",
+            sa.Column(
+                "event_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("events.id", ondelete="cascade"),
+                primary_key=True,
+            ),
+            sa.Column("occurrence", sa.Integer(), primary_key=True),
+            sa.Column("cancelled", sa.Boolean(), nullable=False),
+            sa.Column("title", sa.String(), nullable=True),
+            sa.Column("description", sa.String(), nullable=True),
+            sa.Column("start", sa.Integer(), nullable=True),
+            sa.Column("end", sa.Integer(), nullable=True),
+        )
+    if not inspector.has_table("calendar_changes"):
+        op.create_table(
+            "calendar_changes",
+            sa.Column(
+                "user_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("users.id", ondelete="cascade"),
+                primary_key=True,
+            ),
+            sa.Column("version", sa.Integer(), primary_key=True),
+            sa.Column("event_id", postgresql.UUID(as_uuid=True), primary_key=True),
+            sa.Column("changed_at", sa.Integer(), nullable=False),
+        )
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, options in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                if_not_exists=True,
+                postgresql_concurrently=True,
+                **options,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(
+                name, table_name=table, if_exists=True, postgresql_concurrently=True
+            )
+    # The baseline tables predate Alembic and stay
+    op.drop_table("calendar_changes")
+    op.drop_table("occurrence_overrides")
+    op.drop_column("events", "series_end")
+    op.drop_column("events", "recurrence")
+    op.drop_column("users", "calendar_version")
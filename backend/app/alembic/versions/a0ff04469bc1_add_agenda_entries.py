@@ -0,0 +1,157 @@
+"""Add agenda_entries and backfill it
+
+The per-user read model behind GET /event. The table is created if create_all hasn't
+already, and then filled with the entries rebuild_agenda.py would write, rendered in
+SQL from the tables as they are at this revision, in batches that each commit and lock
+their events as the API's refreshes do. The API keeps the table up to date from then
+on; run it with agenda_reads=false until this has finished.
+
+Revision ID: a0ff04469bc1
+Revises: 3f9c2a7d1b64
+Create Date: 2026-10-18 16:05:27.118240
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a0ff04469bc1"
+down_revision: Union[str, None] = "3f9c2a7d1b64"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+# An event as the API renders it, a CleanEvent with its attendees and overrides
+PAYLOAD = """
+json_build_object(
+    'id', events.id,
+    'title', events.title,
+    'description', events.description,
+    'start', events.start,
+    'end', events."end",
+    'owner', json_build_object('id', owners.id, 'username', owners.username),
+    'attendees', COALESCE(
+        (
+            SELECT json_agg(
+                json_build_object('id', users.id, 'username', users.username)
+                ORDER BY users.id
+            )
+            FROM user_event_association
+            JOIN users ON users.id = user_event_association.user_id
+            WHERE user_event_association.event_id = events.id
+        ),
+        '[]'
+    ),
+    'recurrence', events.recurrence,
+    'occurrence', NULL,
+    'overrides', COALESCE(
+        (
+            SELECT json_agg(
+                json_build_object(
+                    'occurrence', occurrence_overrides.occurrence,
+                    'cancelled', occurrence_overrides.cancelled,
+                    'title', occurrence_overrides.title,
+                    'description', occurrence_overrides.description,
+                    'start', occurrence_overrides.start,
+                    'end', occurrence_overrides."end"
+                )
+                ORDER BY occurrence_overrides.occurrence
+            )
+            FROM occurrence_overrides
+            WHERE occurrence_overrides.event_id = events.id
+        ),
+        '[]'
+    )
+)::text
+"""
+
+# Rewrites the entries of the next batch of events in id order, one per owner and
+# attendee, and returns the last event's id
+BACKFILL_BATCH = f"""
+WITH batch AS (
+    SELECT id FROM events
+    WHERE CAST(:after AS uuid) IS NULL OR id > CAST(:after AS uuid)
+    ORDER BY id
+    LIMIT :batch_size
+    FOR NO KEY UPDATE
+),
+viewers AS (
+    SELECT id AS event_id, owner_id AS user_id FROM events
+    WHERE id IN (SELECT id FROM batch)
+    UNION
+    SELECT event_id, user_id FROM user_event_association
+    WHERE event_id IN (SELECT id FROM batch)
+),
+stale AS (
+    DELETE FROM agenda_entries
+    WHERE event_id IN (SELECT id FROM batch)
+    AND (event_id, user_id) NOT IN (SELECT event_id, user_id FROM viewers)
+),
+written AS (
+    INSERT INTO agenda_entries (event_id, user_id, start, "end", recurring, payload)
+    SELECT
+        events.id,
+        viewers.user_id,
+        events.start,
+        events.series_end,
+        events.recurrence IS NOT NULL,
+        {PAYLOAD}
+    FROM viewers
+    JOIN events ON events.id = viewers.event_id
+    JOIN users AS owners ON owners.id = events.owner_id
+    ON CONFLICT (event_id, user_id) DO UPDATE SET
+        start = excluded.start,
+        "end" = excluded."end",
+        recurring = excluded.recurring,
+        payload = excluded.payload
+)
+SELECT id FROM batch ORDER BY id DESC LIMIT 1
+"""
+
+
+def upgrade() -> None:
+    if not sa.inspect(op.get_bind()).has_table("agenda_entries"):
+        op.create_table(
+            "agenda_entries",
+            sa.Column(
+                "event_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("events.id", ondelete="cascade"),
+                primary_key=True,
+            ),
+            sa.Column(
+                "user_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("users.id", ondelete="cascade"),
+                primary_key=True,
+            ),
+            sa.Column("start", sa.Integer(), nullable=False),
+            sa.Column("end", sa.Integer(), nullable=True),
+            sa.Column("recurring", sa.Boolean(), nullable=False),
+            sa.Column("payload", sa.String(), nullable=False),
+        )
+        op.create_index(
+            "ix_agenda_entries_user_start",
+            "agenda_entries",
+            ["user_id", "start", "event_id"],
+        )
+
+    # Each batch commits on its own, so the API can keep writing meanwhile
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        after = None
+        while True:
+            after = connection.scalar(
+                sa.text(BACKFILL_BATCH), {"after": after, "batch_size": BATCH_SIZE}
+            )
+            if after is None:
+                break
+
+
+def downgrade() -> None:
+    op.drop_table("agenda_entries")
@@ -0,0 +1,193 @@
+"""Archive tables for events that ended long ago
+
+events_archive, user_event_association_archive and occurrence_overrides_archive,
+each range partitioned by series_end. Partitions are created a month at a time by
+the archival job, which moves events over once archive_after is set; until then
+the tables stay empty and the live tables are untouched. Also indexes
+events.series_end, which the job looks events up by. Tables and indexes that
+create_all has already made are left as they are.
+
+Downgrading moves archived events back into the live tables and renders their
+agenda entries in SQL, as rebuild_agenda.py would write them, in the same transaction.
+
+Revision ID: b7c41e9d2f05
+Revises: a0ff04469bc1
+Create Date: 2026-10-18 19:42:08.614502
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b7c41e9d2f05"
+down_revision: Union[str, None] = "a0ff04469bc1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ARCHIVE_KEY = ["event_id", "series_end"]
+ARCHIVE_REFERENCE = ["events_archive.id", "events_archive.series_end"]
+
+# The agenda entries of the archived events once they are live again, one per owner
+# and attendee, each with the event as the API renders it
+ARCHIVED_AGENDA_ENTRIES = """
+INSERT INTO agenda_entries (event_id, user_id, start, "end", recurring, payload)
+SELECT
+    events.id,
+    viewers.user_id,
+    events.start,
+    events.series_end,
+    events.recurrence IS NOT NULL,
+    json_build_object(
+        'id', events.id,
+        'title', events.title,
+        'description', events.description,
+        'start', events.start,
+        'end', events."end",
+        'owner', json_build_object('id', owners.id, 'username', owners.username),
+        'attendees', COALESCE(
+            (
+                SELECT json_agg(
+                    json_build_object('id', users.id, 'username', users.username)
+                    ORDER BY users.id
+                )
+                FROM user_event_association
+                JOIN users ON users.id = user_event_association.user_id
+                WHERE user_event_association.event_id = events.id
+            ),
+            '[]'
+        ),
+        'recurrence', events.recurrence,
+        'occurrence', NULL,
+        'overrides', COALESCE(
+            (
+                SELECT json_agg(
+                    json_build_object(
+                        'occurrence', occurrence_overrides.occurrence,
+                        'cancelled', occurrence_overrides.cancelled,
+                        'title', occurrence_overrides.title,
+                        'description', occurrence_overrides.description,
+                        'start', occurrence_overrides.start,
+                        'end', occurrence_overrides."end"
+                    )
+                    ORDER BY occurrence_overrides.occurrence
+                )
+                FROM occurrence_overrides
+                WHERE occurrence_overrides.event_id = events.id
+            ),
+            '[]'
+        )
+    )::text
+FROM (
+    SELECT id AS event_id, owner_id AS user_id FROM events_archive
+    UNION
+    SELECT event_id, user_id FROM user_event_association_archive
+) AS viewers
+JOIN events ON events.id = viewers.event_id
+JOIN users AS owners ON owners.id = events.owner_id
+"""
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("events_archive"):
+        op.create_table(
+            "events_archive",
+            sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("title", sa.String(), nullable=False),
+            sa.Column("description", sa.String(), nullable=False),
+            sa.Column("start", sa.Integer(), nullable=False),
+            sa.Column("end", sa.Integer(), nullable=False),
+            sa.Column(
+                "owner_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("users.id", ondelete="cascade"),
+                nullable=False,
+            ),
+            sa.Column("recurrence", sa.String(), nullable=True),
+            sa.Column("series_end", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("id", "series_end"),
+            postgresql_partition_by="RANGE (series_end)",
+        )
+        op.create_index("ix_events_archive_owner_id", "events_archive", ["owner_id"])
+    if not inspector.has_table("user_event_association_archive"):
+        op.create_table(
+            "user_event_association_archive",
+            sa.Column(
+                "user_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("users.id", ondelete="cascade"),
+                nullable=False,
+            ),
+            sa.Column("event_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("series_end", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("user_id", "event_id", "series_end"),
+            sa.ForeignKeyConstraint(ARCHIVE_KEY, ARCHIVE_REFERENCE, ondelete="cascade"),
+            postgresql_partition_by="RANGE (series_end)",
+        )
+        op.create_index(
+            "ix_user_event_association_archive_event_id",
+            "user_event_association_archive",
+            ["event_id"],
+        )
+    if not inspector.has_table("occurrence_overrides_archive"):
+        op.create_table(
+            "occurrence_overrides_archive",
+            sa.Column("event_id", postgresql.UUID(as_uuid=True), nullable=False),
+            sa.Column("series_end", sa.Integer(), nullable=False),
+            sa.Column("occurrence", sa.Integer(), nullable=False),
+            sa.Column("cancelled", sa.Boolean(), nullable=False),
+            sa.Column("title", sa.String(), nullable=True),
+            sa.Column("description", sa.String(), nullable=True),
+            sa.Column("start", sa.Integer(), nullable=True),
+            sa.Column("end", sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint("event_id", "series_end", "occurrence"),
+            sa.ForeignKeyConstraint(ARCHIVE_KEY, ARCHIVE_REFERENCE, ondelete="cascade"),
+            postgresql_partition_by="RANGE (series_end)",
+        )
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_events_series_end",
+            "events",
+            ["series_end"],
+            if_not_exists=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    op.execute(
+        'INSERT INTO events (id, title, description, start, "end", owner_id, '
+        "recurrence, series_end) "
+        'SELECT id, title, description, start, "end", owner_id, recurrence, '
+        "series_end FROM events_archive"
+    )
+    op.execute(
+        "INSERT INTO user_event_association (user_id, event_id) "
+        "SELECT user_id, event_id FROM user_event_association_archive"
+    )
+    op.execute(
+        "INSERT INTO occurrence_overrides "
+        '(event_id, occurrence, cancelled, title, description, start, "end") '
+        'SELECT event_id, occurrence, cancelled, title, description, start, "end" '
+        "FROM occurrence_overrides_archive"
+    )
+    op.execute(ARCHIVED_AGENDA_ENTRIES)
+    # Partitions go with their parents
+    op.drop_table("occurrence_overrides_archive")
+    op.drop_table("user_event_association_archive")
+    op.drop_table("events_archive")
+
+    # DROP INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_events_series_end",
+            table_name="events",
+            if_exists=True,
+            postgresql_concurrently=True,
+        )
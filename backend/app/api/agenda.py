@@ -0,0 +1,117 @@
+"""Maintenance and reads of agenda_entries, the pre-rendered per-user calendars.
+
+Every transaction that changes what an event looks like, or who sees it, calls
+refresh_agenda for that event before committing, so the entries are never behind the
+tables they are derived from. GET /event then reads a user's window with one range
+scan of ix_agenda_entries_user_start.
+"""
+
+from typing import List, Sequence
+from uuid import UUID
+
+import orjson
+from api.payloads import event_payload, load_event_rows
+from database.database import AgendaEntry, Event
+from sqlalchemy import (
+    ColumnElement,
+    CompoundSelect,
+    Row,
+    Select,
+    delete,
+    false,
+    insert,
+    or_,
+    select,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Events rendered per round trip, keeping the IN lists well below asyncpg's limit of
+# 32767 parameters
+AGENDA_BATCH_SIZE = 1000
+
+
+def render_json(payload: dict) -> str:
+    # The same encoding as PayloadResponse, so stored events can be sent as they are
+    return orjson.dumps(payload, default=str).decode()
+
+
+async def render_entries(
+    session: AsyncSession, event_ids: Sequence[UUID]
+) -> List[dict]:
+    """The agenda entries the given events should have, one per owner and attendee."""
+    rows = await load_event_rows(session, select(Event).where(Event.id.in_(event_ids)))
+    entries = []
+    for event in rows.events:
+        payload = render_json(event_payload(event, rows))
+        viewers = {event.owner_id}
+        viewers.update(attendee["id"] for attendee in rows.attendees.get(event.id, []))
+        entries += [
+            {
+                "event_id": event.id,
+                "user_id": user_id,
+                "start": event.start,
+                "end": event.series_end,
+                "recurring": event.recurrence is not None,
+                "payload": payload,
+            }
+            for user_id in viewers
+        ]
+    return entries
+
+
+async def refresh_agenda(
+    session: AsyncSession, event_ids: Sequence[UUID] | Select | CompoundSelect
+) -> None:
+    """Rewrite the agenda entries of the given events from the current tables.
+
+    Call this inside the mutating transaction after all of its changes; entries of
+    deleted events and users go with them through their foreign keys. The events are
+    locked first, so that concurrent refreshes of one event take turns and each reads
+    what the one before it committed.
+    """
+    locked = (
+        await session.scalars(
+            select(Event.id)
+            .where(Event.id.in_(event_ids))
+            .order_by(Event.id)
+            .with_for_update(key_share=True)
+        )
+    ).all()
+    for index in range(0, len(locked), AGENDA_BATCH_SIZE):
+        batch = locked[index : index + AGENDA_BATCH_SIZE]
+        await session.execute(
+            delete(AgendaEntry).where(AgendaEntry.event_id.in_(batch))
+        )
+        entries = await render_entries(session, batch)
+        if entries:
+            await session.execute(insert(AgendaEntry), entries)
+
+
+def agenda_window(start: int | None, end: int | None) -> List[ColumnElement[bool]]:
+    """Conditions matching entries overlapping [start, end), the same as in_window
+    matches their events."""
+    if start is None and end is None:
+        return []
+    if start is not None and end is not None and start >= end:
+        return [false()]
+    # As with ranges, an event that takes no time overlaps nothing
+    conditions = [or_(AgendaEntry.end.is_(None), AgendaEntry.start < AgendaEntry.end)]
+    if end is not None:
+        conditions.append(AgendaEntry.start < end)
+    if start is not None:
+        conditions.append(or_(AgendaEntry.end.is_(None), AgendaEntry.end > start))
+    return conditions
+
+
+async def load_agenda(
+    session: AsyncSession, user_id: UUID, start: int | None, end: int | None
+) -> List[Row]:
+    """(payload, recurring) of the user's entries overlapping [start, end), ordered
+    like load_event_rows orders events."""
+    return (
+        await session.execute(
+            select(AgendaEntry.payload, AgendaEntry.recurring)
+            .where(AgendaEntry.user_id == user_id, *agenda_window(start, end))
+            .order_by(AgendaEntry.start, AgendaEntry.event_id)
+        )
+    ).all()
@@ -1,23 +1,67 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from typing import Annotated, List
+from typing import Annotated, AsyncIterator, List
 from uuid import UUID, uuid4
 
+from admission import AdmissionMiddleware
 from api.routers.event import router as event_router
+from api.routers.freebusy import router as freebusy_router
 from api.routers.user import router as user_router
-from database.database import DBSession, Event, User
+from config.config import settings
+from database.archive import archive_old_events
+from database.calendar import truncate_change_log
+from database.database import (
+    DBSession,
+    Event,
+    User,
+    create_engines,
+    create_schema,
+    dispose_engines,
+)
+from database.pubsub import broker
 from fastapi import Depends, FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from metrics import MetricsMiddleware, instrument_engine, metrics
 from models import SuccessResponse, UserData
 from pydantic import BaseModel
+from security import hashing
 from security.access import Token, authenticate_user, create_access_token
+from security.cache import load_taken_names
 from sqlalchemy import insert, select
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    engine, async_engine = create_engines()
+    instrument_engine(engine)
+    instrument_engine(async_engine.sync_engine)
+    if settings.create_schema:
+        await create_schema()
+    await broker.start()
+    # After the broker has started, so that no name announced meanwhile is missed
+    await load_taken_names()
+    change_log_truncation = asyncio.create_task(truncate_change_log())
+    archival = asyncio.create_task(archive_old_events())
+
+    yield
+
+    archival.cancel()
+    change_log_truncation.cancel()
+    hashing.shutdown()
+    await broker.stop()
+    await dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Inside CORS and metrics, so that rejected requests get CORS headers and are counted
+app.add_middleware(AdmissionMiddleware)
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -30,19 +74,28 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(event_router)
+app.include_router(freebusy_router)
 app.include_router(user_router)
 
 
 @app.get("/ping")
-def health_check() -> SuccessResponse:
+async def health_check() -> SuccessResponse:
     return SuccessResponse()
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/token")
-def authorize_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:
-    user: UserData = authenticate_user(form_data.username, form_data.password)
+async def authorize_user(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+) -> Token:
+    user: UserData = await authenticate_user(form_data.username, form_data.password)
     access_token_expires = timedelta(minutes=30)
     access_token = create_access_token(
         data={"sub": str(user.id)}, expires_delta=access_token_expires
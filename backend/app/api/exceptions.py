@@ -6,6 +6,47 @@ EventNotOwnedException = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED, detail="User does not own the target event"
 )
 
+InvalidCursorException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
+)
+
+ChangesExpiredException = HTTPException(
+    status_code=status.HTTP_410_GONE,
+    detail="Change history is no longer available for this cursor, resync without one",
+)
+
+NotRecurringException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST, detail="Event is not recurring"
+)
+
+InvalidRecurrenceException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="The event's recurrence rule is no longer supported, edit it first",
+)
+
+NoSuchOccurrenceException = HTTPException(
+    status_code=status.HTTP_404_NOT_FOUND, detail="Event has no occurrence at that time"
+)
+
+OccurrenceOutsideSeriesException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Occurrences can only be moved within the span of their series",
+)
+
+ConflictingEventException = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail="Event overlaps existing commitments of its owner or attendees",
+)
+
+EventOutOfRangeException = HTTPException(
+    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+    detail="Events and their series must fall between 1901 and 2038",
+)
+
+InvalidWindowException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST, detail="Window must end after it starts"
+)
+
 
 def DoesNotExistException(type: type) -> HTTPException:
     return HTTPException(
@@ -0,0 +1,278 @@
+"""Event payloads built straight from rows, for handlers that return many events.
+
+CleanEvent documents the shape in the OpenAPI schema, but building and then
+re-validating a model per event and attendee costs more than the queries behind
+them. These functions produce the same structure as plain dicts, ready to be encoded
+by a PayloadResponse, so keep the two in step.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, Tuple
+from uuid import UUID
+
+import orjson
+from database.calendar import occurrence_times
+from database.database import LIVE, EventTables, OccurrenceOverride, User
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import Row, Select, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class PayloadResponse(ORJSONResponse):
+    def render(self, content: object) -> bytes:
+        # asyncpg returns ids as its own UUID type, which orjson doesn't recognise
+        return orjson.dumps(content, default=str)
+
+
+@dataclass
+class EventRows:
+    """The rows behind a list of events: the events with their owners' usernames, in
+    order, and the attendees and overrides of each by event id."""
+
+    events: List[Row]
+    attendees: Dict[UUID, List[dict]]
+    overrides: Dict[UUID, List[OccurrenceOverride]]
+
+
+async def load_event_rows(
+    session: AsyncSession,
+    query: Select,
+    limit: int | None = None,
+    tables: EventTables = LIVE,
+) -> EventRows:
+    """Run a select(Event) query as three column queries, ordering events by start.
+
+    The attendee and override queries filter on the event query itself rather than
+    on a list of ids, so they stay one round trip each however many events match.
+    For the archive, pass a select(ArchivedEvent) query with tables=ARCHIVE.
+    """
+    table = tables.events
+    ordered = query.order_by(table.start, table.id)
+    if limit is not None:
+        # The attendee and override queries then select from the same page
+        query = ordered = ordered.limit(limit)
+    events = (
+        await session.execute(
+            ordered.with_only_columns(
+                table.id,
+                table.title,
+                table.description,
+                table.start,
+                table.end,
+                table.owner_id,
+                User.username.label("owner_username"),
+                table.recurrence,
+                table.series_end,
+            ).join_from(table, User, User.id == table.owner_id)
+        )
+    ).all()
+    if not events:
+        return EventRows([], {}, {})
+
+    event_ids = query.with_only_columns(table.id)
+    attendance, override_table = tables.attendance, tables.overrides
+    attendance_window, override_window = [], []
+    if tables.partitioned:
+        # Literal bounds on the partition key, which the planner can prune with
+        # where it can't with the event query
+        low = min(event.series_end for event in events)
+        high = max(event.series_end for event in events)
+        attendance_window = [attendance.c.series_end.between(low, high)]
+        override_window = [override_table.series_end.between(low, high)]
+    attendees = defaultdict(list)
+    for event_id, user_id, username in await session.execute(
+        select(attendance.c.event_id, User.id, User.username)
+        .join(User, User.id == attendance.c.user_id)
+        .where(attendance.c.event_id.in_(event_ids), *attendance_window)
+    ):
+        attendees[event_id].append({"id": user_id, "username": username})
+
+    overrides = defaultdict(list)
+    if any(event.recurrence is not None for event in events):
+        for override in await session.scalars(
+            select(override_table).where(
+                override_table.event_id.in_(
+                    event_ids.where(table.recurrence.is_not(None))
+                ),
+                *override_window,
+            )
+        ):
+            overrides[override.event_id].append(override)
+    return EventRows(events, attendees, overrides)
+
+
+def event_payload(event: Row, rows: EventRows) -> dict:
+    """An event as a CleanEvent dict, recurring ones with their rule and overrides."""
+    return {
+        "id": event.id,
+        "title": event.title,
+        "description": event.description,
+        "start": event.start,
+        "end": event.end,
+        "owner": {"id": event.owner_id, "username": event.owner_username},
+        "attendees": rows.attendees.get(event.id, []),
+        "recurrence": event.recurrence,
+        "occurrence": None,
+        "overrides": [
+            {
+                "occurrence": override.occurrence,
+                "cancelled": override.cancelled,
+                "title": override.title,
+                "description": override.description,
+                "start": override.start,
+                "end": override.end,
+            }
+            for override in rows.overrides.get(event.id, [])
+        ],
+    }
+
+
+def event_payloads(rows: EventRows) -> List[dict]:
+    return [event_payload(event, rows) for event in rows.events]
+
+
+def merge_event_rows(first: EventRows, second: EventRows) -> EventRows:
+    """Both sets of rows as one, such as live and archived events, ordered by start
+    like load_event_rows orders them."""
+    if not second.events:
+        return first
+    return EventRows(
+        sorted(first.events + second.events, key=event_order),
+        first.attendees | second.attendees,
+        first.overrides | second.overrides,
+    )
+
+
+def event_order(event: Row | dict) -> tuple:
+    """The order of load_event_rows, for events or their payloads. Ids compare as
+    text, which orders them the same way as the database's uuid comparison does."""
+    if isinstance(event, dict):
+        return (event["start"], str(event["id"]))
+    return (event.start, str(event.id))
+
+
+def occurrence_payloads(rows: EventRows, start: int | None, end: int) -> List[dict]:
+    """Single events as-is and recurring ones as their occurrences in the window,
+    with per-occurrence overrides applied, ordered by start."""
+    return sorted(_expand(rows, start, end), key=lambda event: event["start"])
+
+
+def expand_payloads(events: Iterable[dict], start: int | None, end: int) -> List[dict]:
+    """occurrence_payloads for events that are already payloads, such as stored ones."""
+    return sorted(
+        (
+            instance
+            for payload in events
+            for instance in _occurrences(
+                payload,
+                SimpleNamespace(**payload),
+                [SimpleNamespace(**override) for override in payload["overrides"]],
+                start,
+                end,
+            )
+        ),
+        key=lambda event: event["start"],
+    )
+
+
+def _expand(rows: EventRows, start: int | None, end: int) -> Iterator[dict]:
+    for event in rows.events:
+        yield from _occurrences(
+            event_payload(event, rows),
+            event,
+            rows.overrides.get(event.id, []),
+            start,
+            end,
+        )
+
+
+def _occurrences(
+    payload: dict,
+    event: Row | SimpleNamespace,
+    overrides: List[OccurrenceOverride | SimpleNamespace],
+    start: int | None,
+    end: int,
+) -> Iterator[dict]:
+    if event.recurrence is None:
+        yield payload
+        return
+
+    payload = payload | {"overrides": []}
+    for occurrence, occurrence_start, occurrence_end, override in occurrence_times(
+        event, overrides, start, end
+    ):
+        instance = payload | {
+            "start": occurrence_start,
+            "end": occurrence_end,
+            "occurrence": occurrence,
+        }
+        if override is not None:
+            if override.title is not None:
+                instance["title"] = override.title
+            if override.description is not None:
+                instance["description"] = override.description
+        yield instance
+
+
+EVENT_FIELDS = (
+    "id",
+    "title",
+    "description",
+    "start",
+    "end",
+    "owner",
+    "attendees",
+    "recurrence",
+    "occurrence",
+    "overrides",
+)
+
+
+def compact_payload(events: List[dict]) -> dict:
+    """Events with each owner and attendee replaced by an index into one users table,
+    so people who appear on many events are sent once."""
+    users: List[dict] = []
+    positions: Dict[str, int] = {}
+
+    def position(user: dict) -> int:
+        # Stored payloads carry ids as text and rows as UUIDs, which don't compare
+        # equal, so a user on both live and archived events would be listed twice
+        user_id = str(user["id"])
+        if user_id not in positions:
+            positions[user_id] = len(users)
+            users.append(user)
+        return positions[user_id]
+
+    compact_events = [
+        event
+        | {
+            "owner": position(event["owner"]),
+            "attendees": [position(attendee) for attendee in event["attendees"]],
+        }
+        for event in events
+    ]
+    return {"users": users, "events": compact_events}
+
+
+def columnar_payload(events: List[dict]) -> dict:
+    """The compact payload with users and events each as one array per field."""
+    compact = compact_payload(events)
+    return {
+        "users": _columns(compact["users"], ("id", "username")),
+        "events": _columns(compact["events"], EVENT_FIELDS),
+    }
+
+
+def _columns(records: Iterable[dict], fields: Tuple[str, ...]) -> Dict[str, list]:
+    return {field: [record[field] for record in records] for field in fields}
+
+
+PayloadFormat = Literal["full", "compact", "columnar"]
+
+FORMATS: Dict[PayloadFormat, Callable[[List[dict]], object]] = {
+    "full": lambda events: events,
+    "compact": compact_payload,
+    "columnar": columnar_payload,
+}
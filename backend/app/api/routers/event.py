@@ -1,23 +1,127 @@
-from typing import Annotated, List, Set
-from uuid import UUID
+import asyncio
+import time
+from typing import (
+    Annotated,
+    AsyncIterator,
+    Dict,
+    List,
+    Literal,
+    Set,
+    Tuple,
+    Union,
+)
+from uuid import UUID, uuid4
 
-from api.exceptions import DoesNotExistException, EventNotOwnedException
-from database.database import DBSession, Event, User
-from fastapi import APIRouter, Depends, HTTPException, status
+import ical
+import orjson
+from api.agenda import load_agenda, refresh_agenda
+from api.exceptions import (
+    ChangesExpiredException,
+    ConflictingEventException,
+    DoesNotExistException,
+    EventNotOwnedException,
+    EventOutOfRangeException,
+    InvalidCursorException,
+    InvalidRecurrenceException,
+    NoSuchOccurrenceException,
+    NotRecurringException,
+    OccurrenceOutsideSeriesException,
+)
+from api.payloads import (
+    FORMATS,
+    PayloadFormat,
+    PayloadResponse,
+    event_order,
+    event_payloads,
+    expand_payloads,
+    load_event_rows,
+    merge_event_rows,
+    occurrence_payloads,
+)
+from config.config import settings
+from database.archive import archive_window
+from database.calendar import (
+    bump_calendar_versions,
+    calendar_etag,
+    changed_event_ids,
+    find_conflicts,
+    in_window,
+)
+from database.database import (
+    ARCHIVE,
+    ArchivedEvent,
+    AsyncDBSession,
+    Event,
+    OccurrenceOverride,
+    User,
+    archived_attendance,
+    user_event_association,
+)
+from database.pubsub import broker
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.responses import StreamingResponse
 from models import SuccessResponse, UserData, UserInfo
-from pydantic import BaseModel
-from security.access import get_current_user
-from sqlalchemy import or_, select, update
-from sqlalchemy.orm import Session, lazyload
+from pydantic import BaseModel, Field, field_validator
+from recurrence import TIME_RANGE, is_occurrence, occurrences, parse_rule, series_end
+from security.access import get_current_user, get_current_user_from_token
+from sqlalchemy import Row, Select, delete, insert, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 
 router = APIRouter()
 
+# Window bounds are compared with the int4 time columns, which can't hold others
+WindowBound = Annotated[int | None, Query(ge=TIME_RANGE.start, le=TIME_RANGE.stop - 1)]
+# Times stored as they are given
+Timestamp = Annotated[int, Field(ge=TIME_RANGE.start, le=TIME_RANGE.stop - 1)]
+
+
+def check_recurrence(value: str | None) -> str | None:
+    if value:
+        parse_rule(value)
+    return value
+
+
+def checked_series_end(start: int, end: int, recurrence: str | None) -> int | None:
+    """series_end, for an event whose times must all fit in the database."""
+    last_end = series_end(start, end, recurrence)
+    if (
+        start not in TIME_RANGE
+        or end not in TIME_RANGE
+        or last_end is not None
+        and last_end not in TIME_RANGE
+    ):
+        raise EventOutOfRangeException
+    return last_end
+
 
 class NewEvent(BaseModel):
     title: str
     description: str
     start: int
     end: int
+    recurrence: str | None = None
+
+    _check_recurrence = field_validator("recurrence")(check_recurrence)
+
+
+class OverrideInfo(BaseModel):
+    occurrence: int
+    cancelled: bool
+    title: str | None = None
+    description: str | None = None
+    start: int | None = None
+    end: int | None = None
 
 
 class CleanEvent(BaseModel):
@@ -28,85 +132,817 @@ class CleanEvent(BaseModel):
     end: int
     owner: UserInfo
     attendees: List[UserInfo]
+    recurrence: str | None = None
+    # Set on expanded occurrences of a recurring event: the occurrence's original start
+    occurrence: int | None = None
+    # Set on unexpanded recurring events
+    overrides: List[OverrideInfo] = []
+
+
+class CompactEvent(CleanEvent):
+    # Indexes into the users table
+    owner: int
+    attendees: List[int]
+
+
+class CompactCalendar(BaseModel):
+    users: List[UserInfo]
+    events: List[CompactEvent]
+
+
+class ColumnarCalendar(BaseModel):
+    # One array per field of UserInfo and of CompactEvent respectively
+    users: Dict[str, list]
+    events: Dict[str, list]
+
+
+class EventPage(BaseModel):
+    events: List[CleanEvent]
+    next_cursor: str | None = None
+
+
+def visible_events(
+    user_id: UUID, start: int | None = None, end: int | None = None
+) -> Select:
+    """Events the user owns or attends, optionally those overlapping [start, end)."""
+    query = select(Event).where(
+        or_(
+            Event.owner_id == user_id,
+            Event.id.in_(
+                select(user_event_association.c.event_id).where(
+                    user_event_association.c.user_id == user_id
+                )
+            ),
+        )
+    )
+    return query.where(*in_window(start, end))
+
+
+def visible_archived_events(
+    user_id: UUID, start: int | None = None, end: int | None = None
+) -> Select:
+    """visible_events for events that have been archived. Windows that start after
+    the newest archived month skip the archive's partitions altogether."""
+    attended = select(
+        archived_attendance.c.event_id, archived_attendance.c.series_end
+    ).where(archived_attendance.c.user_id == user_id)
+    if start is not None:
+        attended = attended.where(archived_attendance.c.series_end > start)
+    return select(ArchivedEvent).where(
+        or_(
+            ArchivedEvent.owner_id == user_id,
+            tuple_(ArchivedEvent.id, ArchivedEvent.series_end).in_(attended),
+        ),
+        *archive_window(start, end),
+    )
+
+
+def with_people(
+    query: Select, table: type[Event] | type[ArchivedEvent] = Event
+) -> Select:
+    """Eager-load everything to_components reads, so it issues no per-event queries."""
+    return query.options(
+        joinedload(table.owner),
+        selectinload(table.attendees),
+        selectinload(table.overrides),
+    )
+
+
+def encode_cursor(event: Event) -> str:
+    return f"{event.start}:{event.id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[int, UUID]:
+    try:
+        start, event_id = cursor.split(":", 1)
+        return int(start), UUID(event_id)
+    except ValueError:
+        raise InvalidCursorException
 
 
 @router.get("/event")
-def get_events(
-    current_user: Annotated[UserData, Depends(get_current_user)]
-) -> List[CleanEvent]:
-    session: Session
-    with DBSession() as session:
-        user = session.scalar(
-            select(User)
-            .where(User.id == current_user.id)
-            .options(lazyload(User.attending_events))
-            .options(lazyload(User.owned_events))
-        )
-
-        event_list = user.owned_events + user.attending_events
-
-        return [
-            CleanEvent(
-                id=event.id,
-                title=event.title,
-                description=event.description,
-                start=event.start,
-                end=event.end,
-                owner=UserInfo(id=event.owner_id, username=event.owner.username),
-                attendees=[
-                    UserInfo(id=attendee.id, username=attendee.username)
-                    for attendee in event.attendees
+async def get_events(
+    current_user: Annotated[UserData, Depends(get_current_user)],
+    start: WindowBound = None,
+    end: WindowBound = None,
+    payload_format: Annotated[PayloadFormat, Query(alias="format")] = "full",
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Union[List[CleanEvent], CompactCalendar, ColumnarCalendar]:
+    """The user's events, optionally only those overlapping [start, end).
+
+    With format=compact, owners and attendees are indexes into a single users table
+    instead of being repeated on every event. format=columnar further turns the users
+    and events into one array per field.
+    """
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        # Read the version before the events: a concurrent write can then only make
+        # the tag older than the data, costing the client a refetch, never a stale hit.
+        version = await session.scalar(
+            select(User.calendar_version).where(User.id == current_user.id)
+        )
+        etag = calendar_etag(current_user.id, version)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if if_none_match == etag:
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers
+            )
+
+        archived = await load_event_rows(
+            session,
+            visible_archived_events(current_user.id, start, end),
+            tables=ARCHIVE,
+        )
+        # Without an upper bound recurring events can't be expanded, so clients get
+        # each series once with its rule and overrides
+        if settings.agenda_reads:
+            entries = await load_agenda(session, current_user.id, start, end)
+            if (
+                payload_format == "full"
+                and not archived.events
+                and (end is None or not any(entry.recurring for entry in entries))
+            ):
+                # Nothing to expand or restructure, so the stored JSON is the response
+                return Response(
+                    "[" + ",".join(entry.payload for entry in entries) + "]",
+                    media_type="application/json",
+                    headers=cache_headers,
+                )
+            events = [orjson.loads(entry.payload) for entry in entries]
+            if archived.events:
+                events = sorted(events + event_payloads(archived), key=event_order)
+            if end is not None:
+                events = expand_payloads(events, start, end)
+        else:
+            rows = merge_event_rows(
+                await load_event_rows(
+                    session, visible_events(current_user.id, start, end)
+                ),
+                archived,
+            )
+            events = (
+                event_payloads(rows)
+                if end is None
+                else occurrence_payloads(rows, start, end)
+            )
+        return PayloadResponse(FORMATS[payload_format](events), headers=cache_headers)
+
+
+@router.get("/event/page")
+async def get_event_page(
+    current_user: Annotated[UserData, Depends(get_current_user)],
+    start: WindowBound = None,
+    end: WindowBound = None,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=500)] = 100,
+) -> EventPage:
+    query = visible_events(current_user.id, start, end)
+    archived = visible_archived_events(current_user.id, start, end)
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        query = query.where(tuple_(Event.start, Event.id) > after)
+        # Series end no earlier than they start, which lets the archive skip the
+        # partitions of months before the cursor
+        archived = archived.where(
+            tuple_(ArchivedEvent.start, ArchivedEvent.id) > after,
+            ArchivedEvent.series_end >= after[0],
+        )
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        # The first `limit` of live and archived events together are among the
+        # first `limit` of each
+        rows = merge_event_rows(
+            await load_event_rows(session, query, limit),
+            await load_event_rows(session, archived, limit, tables=ARCHIVE),
+        )
+        rows.events = rows.events[:limit]
+        return PayloadResponse(
+            {
+                "events": event_payloads(rows),
+                "next_cursor": (
+                    encode_cursor(rows.events[-1])
+                    if len(rows.events) == limit
+                    else None
+                ),
+            }
+        )
+
+
+class EventChanges(BaseModel):
+    events: List[CleanEvent]
+    deleted: List[UUID]
+    cursor: int
+
+
+@router.get("/event/changes")
+async def get_event_changes(
+    current_user: Annotated[UserData, Depends(get_current_user)],
+    since: int | None = None,
+) -> EventChanges:
+    """Events added or changed, and ids of events deleted or no longer visible, since
+    the given cursor. Without a cursor, returns the whole calendar and a fresh cursor.
+    """
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        # As with the ETag, read the version first so the cursor never runs ahead
+        version = await session.scalar(
+            select(User.calendar_version).where(User.id == current_user.id)
+        )
+        query = visible_events(current_user.id)
+        event_ids = None
+        if since is not None:
+            if since > version:
+                raise ChangesExpiredException
+            if since == version:
+                return EventChanges(events=[], deleted=[], cursor=version)
+            event_ids = await changed_event_ids(session, current_user.id, since)
+            if event_ids is None:
+                raise ChangesExpiredException
+            query = query.where(Event.id.in_(event_ids))
+
+        rows = await load_event_rows(session, query)
+        visible = {event.id for event in rows.events}
+        archived = visible_archived_events(current_user.id)
+        if event_ids is not None:
+            # Events changed since the cursor are rarely archived by now, so the
+            # archive is only searched for the ones that aren't live
+            archived = archived.where(ArchivedEvent.id.in_(set(event_ids) - visible))
+        if event_ids is None or not visible.issuperset(event_ids):
+            rows = merge_event_rows(
+                rows, await load_event_rows(session, archived, tables=ARCHIVE)
+            )
+            visible = {event.id for event in rows.events}
+        return PayloadResponse(
+            {
+                "events": event_payloads(rows),
+                "deleted": [
+                    event_id for event_id in event_ids or [] if event_id not in visible
                 ],
+                "cursor": version,
+            }
+        )
+
+
+KEEPALIVE_SECONDS = 25
+
+
+@router.get("/event/stream")
+async def stream_event_changes(
+    current_user: Annotated[UserData, Depends(get_current_user_from_token)],
+) -> StreamingResponse:
+    """Server-sent events carrying the user's new calendar version whenever it changes.
+
+    Browsers cannot set headers on an EventSource, so this takes the token as a query
+    parameter. Clients should follow each message with a call to /event/changes.
+    """
+    queue = broker.subscribe(current_user.id)
+
+    async def messages() -> AsyncIterator[str]:
+        try:
+            while True:
+                try:
+                    version = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: calendar\ndata: {version}\n\n"
+        finally:
+            broker.unsubscribe(current_user.id, queue)
+
+    return StreamingResponse(
+        messages(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def to_components(event: Event | ArchivedEvent, stamp: int) -> str:
+    """An event as a VEVENT, plus one per edited occurrence if it is recurring."""
+    owner = (event.owner_id, event.owner.username)
+    attendees = [(attendee.id, attendee.username) for attendee in event.attendees]
+    components = [
+        ical.vevent(
+            str(event.id),
+            stamp,
+            event.start,
+            event.end,
+            event.title,
+            event.description,
+            owner,
+            attendees,
+            recurrence=event.recurrence and event.recurrence.removeprefix("RRULE:"),
+            exdates=[
+                override.occurrence
+                for override in event.overrides
+                if override.cancelled
+            ],
+        )
+    ]
+    for override in event.overrides:
+        if override.cancelled:
+            continue
+        start = override.start if override.start is not None else override.occurrence
+        components.append(
+            ical.vevent(
+                str(event.id),
+                stamp,
+                start,
+                (
+                    override.end
+                    if override.end is not None
+                    else start + event.end - event.start
+                ),
+                override.title if override.title is not None else event.title,
+                (
+                    override.description
+                    if override.description is not None
+                    else event.description
+                ),
+                owner,
+                attendees,
+                recurrence_id=override.occurrence,
             )
-            for event in event_list
-        ]
+        )
+    return "".join(components)
 
 
-@router.post("/event/new")
-def add_event(
-    event: NewEvent, current_user: Annotated[UserData, Depends(get_current_user)]
-) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        user = session.scalar(select(User).where(User.id == current_user.id))
-
-        session.add(
-            Event(
-                title=event.title,
-                description=event.description,
-                start=event.start,
-                end=event.end,
-                owner=user,
+@router.get("/event/export.ics")
+async def export_events(
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> StreamingResponse:
+    """The user's whole calendar as an iCalendar file.
+
+    Events are read through a server-side cursor in batches and written out as they
+    arrive, so memory use stays flat however many events the calendar holds.
+    """
+    stamp = int(time.time())
+
+    async def calendar() -> AsyncIterator[str]:
+        yield ical.CALENDAR_HEADER
+        session: AsyncSession
+        async with AsyncDBSession() as session:
+            for table, query in (
+                (Event, visible_events(current_user.id)),
+                (ArchivedEvent, visible_archived_events(current_user.id)),
+            ):
+                events = await session.stream_scalars(
+                    with_people(query, table)
+                    .order_by(table.start, table.id)
+                    .execution_options(yield_per=EXPORT_BATCH_SIZE)
+                )
+                async for batch in events.partitions():
+                    yield "".join(to_components(event, stamp) for event in batch)
+        yield ical.CALENDAR_FOOTER
+
+    return StreamingResponse(
+        calendar(),
+        media_type="text/calendar",
+        headers={"Content-Disposition": 'attachment; filename="calendar.ics"'},
+    )
+
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_CHUNK_SIZE = 64 * 1024
+# Every skipped component is counted, but only the first reasons are reported
+MAX_IMPORT_ERRORS = 20
+
+
+class ImportProgress(BaseModel):
+    imported: int = 0
+    skipped: int = 0
+    errors: List[str] = []
+    # Only set on the last line, once everything imported has been committed
+    done: bool = False
+
+
+class EventImport:
+    """Bulk loads parsed VEVENTs into a user's calendar inside the caller's transaction.
+
+    Attendees are resolved by username, once per name across the whole import. Edited
+    occurrences are held back until the end, since their series may come later.
+    """
+
+    def __init__(self, session: AsyncSession, owner_id: UUID) -> None:
+        self.session = session
+        self.owner_id = owner_id
+        self.progress = ImportProgress()
+        self.user_ids: Dict[str, UUID | None] = {}
+        # Recurring events imported so far by UID
+        self.series: Dict[str, Tuple[UUID, ical.VEvent, int | None]] = {}
+        self.occurrence_edits: List[ical.VEvent] = []
+
+    def skip(self, reason: str) -> None:
+        self.progress.skipped += 1
+        if len(self.progress.errors) < MAX_IMPORT_ERRORS:
+            self.progress.errors.append(reason)
+
+    def accept(self, properties: List[ical.Property]) -> ical.VEvent | None:
+        """Parse and validate a VEVENT, returning it if it belongs in the next batch."""
+        try:
+            event = ical.read_vevent(properties)
+        except ValueError as error:
+            self.skip(str(error))
+            return None
+        try:
+            last_end = series_end(event.start, event.end, event.recurrence)
+        except ValueError as error:
+            self.skip(f"Event {event.uid} has an unsupported recurrence: {error}")
+            return None
+        times = [event.start, event.end, *event.exdates]
+        if last_end is not None:
+            times.append(last_end)
+        if event.recurrence_id is not None:
+            times.append(event.recurrence_id)
+        if any(timestamp not in TIME_RANGE for timestamp in times):
+            self.skip(f"Event {event.uid} is outside the supported time range")
+            return None
+        if event.recurrence_id is not None:
+            self.occurrence_edits.append(event)
+            return None
+        return event
+
+    async def resolve(self, usernames: Set[str]) -> None:
+        unknown = usernames - self.user_ids.keys()
+        if unknown:
+            found = dict(
+                (
+                    await self.session.execute(
+                        select(User.username, User.id).where(User.username.in_(unknown))
+                    )
+                ).all()
+            )
+            self.user_ids |= {username: found.get(username) for username in unknown}
+
+    async def store(self, events: List[ical.VEvent]) -> None:
+        await self.resolve({name for event in events for name in event.attendees})
+
+        rows, attendance, cancellations = [], [], []
+        for event in events:
+            event_id = uuid4()
+            last_end = series_end(event.start, event.end, event.recurrence)
+            rows.append(
+                {
+                    "id": event_id,
+                    "title": event.title,
+                    "description": event.description,
+                    "start": event.start,
+                    "end": event.end,
+                    "owner_id": self.owner_id,
+                    "recurrence": event.recurrence,
+                    "series_end": last_end,
+                }
             )
+            attendees = {self.user_ids[name] for name in event.attendees}
+            attendance += [
+                {"user_id": user_id, "event_id": event_id}
+                for user_id in attendees - {None, self.owner_id}
+            ]
+            if event.recurrence is not None:
+                if event.uid is not None:
+                    self.series[event.uid] = (event_id, event, last_end)
+                cancellations += [
+                    {"event_id": event_id, "occurrence": exdate, "cancelled": True}
+                    for exdate in set(event.exdates)
+                ]
+
+        await self.session.execute(insert(Event), rows)
+        if attendance:
+            await self.session.execute(insert(user_event_association), attendance)
+        if cancellations:
+            await self.session.execute(insert(OccurrenceOverride), cancellations)
+        await bump_calendar_versions(self.session, [row["id"] for row in rows])
+        await refresh_agenda(self.session, [row["id"] for row in rows])
+        self.progress.imported += len(rows)
+
+    async def store_occurrence_edits(self) -> None:
+        overrides = {}
+        for edit in self.occurrence_edits:
+            if edit.uid not in self.series:
+                self.skip(f"No recurring event {edit.uid} for edited occurrence")
+                continue
+            event_id, event, last_end = self.series[edit.uid]
+            try:
+                found = is_occurrence(
+                    event.start, event.end, event.recurrence, edit.recurrence_id
+                )
+            except ValueError as error:
+                self.skip(f"Event {edit.uid} has an unsupported recurrence: {error}")
+                continue
+            if not found:
+                self.skip(f"Event {edit.uid} has no occurrence at {edit.recurrence_id}")
+                continue
+            if edit.start < event.start or (
+                last_end is not None and edit.end > last_end
+            ):
+                self.skip(f"Edited occurrence of {edit.uid} is outside its series")
+                continue
+            # A later edit of the same occurrence replaces an earlier one or an EXDATE
+            overrides[event_id, edit.recurrence_id] = {
+                "event_id": event_id,
+                "occurrence": edit.recurrence_id,
+                "cancelled": edit.cancelled,
+                "title": edit.title,
+                "description": edit.description,
+                "start": edit.start,
+                "end": edit.end,
+            }
+        if not overrides:
+            return
+
+        statement = pg_insert(OccurrenceOverride)
+        await self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[
+                    OccurrenceOverride.event_id,
+                    OccurrenceOverride.occurrence,
+                ],
+                set_={
+                    column: statement.excluded[column]
+                    for column in ("cancelled", "title", "description", "start", "end")
+                },
+            ),
+            list(overrides.values()),
         )
-        session.commit()
-    return SuccessResponse()
+        event_ids = list({event_id for event_id, _ in overrides})
+        for index in range(0, len(event_ids), IMPORT_BATCH_SIZE):
+            await bump_calendar_versions(
+                self.session, event_ids[index : index + IMPORT_BATCH_SIZE]
+            )
+        await refresh_agenda(self.session, event_ids)
+        self.progress.imported += len(overrides)
+
+
+@router.post("/event/import.ics")
+async def import_events(
+    file: UploadFile, current_user: Annotated[UserData, Depends(get_current_user)]
+) -> StreamingResponse:
+    """Add the events of an uploaded iCalendar file to the user's calendar.
+
+    The file is parsed incrementally and stored in batches within one transaction.
+    The response is a stream of ImportProgress JSON lines, one per batch; the import
+    was committed only if the last line has done set. Components that can't be stored
+    are skipped, and attendees who aren't users of this calendar are left out.
+    """
+
+    async def progress() -> AsyncIterator[str]:
+        session: AsyncSession
+        async with AsyncDBSession() as session:
+            importer = EventImport(session, current_user.id)
+            reader = ical.ComponentReader()
+            batch = []
+            while True:
+                chunk = await file.read(IMPORT_CHUNK_SIZE)
+                for properties in reader.feed(chunk) if chunk else reader.close():
+                    event = importer.accept(properties)
+                    if event is not None:
+                        batch.append(event)
+                    if len(batch) == IMPORT_BATCH_SIZE:
+                        await importer.store(batch)
+                        batch = []
+                        yield importer.progress.model_dump_json() + "\n"
+                if not chunk:
+                    break
+
+            if batch:
+                await importer.store(batch)
+            await importer.store_occurrence_edits()
+            await session.commit()
+
+        importer.progress.done = True
+        yield importer.progress.model_dump_json() + "\n"
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
+
+
+ConflictMode = Literal["ignore", "flag", "reject"]
+
+
+class EventConflict(BaseModel):
+    user_id: UUID
+    start: int
+    end: int
+
+
+class SavedEvent(SuccessResponse):
+    # Commitments of the owner or attendees that the event overlaps, when flagged
+    conflicts: List[EventConflict] = []
+
+
+async def check_conflicts(
+    session: AsyncSession,
+    mode: ConflictMode,
+    user_ids: Set[UUID],
+    start: int,
+    end: int,
+    recurrence: str | None,
+    exclude: UUID | None = None,
+) -> List[EventConflict]:
+    """Find what the event's times overlap in the users' calendars, raising if the
+    mode is reject. Only times are reported, as other users' events may be private."""
+    if mode == "ignore":
+        return []
+    if recurrence is None:
+        times = [(start, end)]
+    else:
+        # Stop where occurrences would no longer end within int4, as an unbounded
+        # series near the end of the range otherwise would
+        horizon = min(
+            start + settings.conflict_horizon, TIME_RANGE.stop - (end - start)
+        )
+        times = list(occurrences(start, end, parse_rule(recurrence), start, horizon))
+    conflicts = [
+        EventConflict(user_id=user_id, start=conflict_start, end=conflict_end)
+        for user_id, conflict_start, conflict_end in await find_conflicts(
+            session, user_ids, times, exclude
+        )
+    ]
+    if conflicts and mode == "reject":
+        raise ConflictingEventException
+    return conflicts
+
+
+@router.post("/event/new")
+async def add_event(
+    event: NewEvent,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+    conflicts: ConflictMode = "ignore",
+) -> SavedEvent:
+    last_end = checked_series_end(event.start, event.end, event.recurrence or None)
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        found = await check_conflicts(
+            session,
+            conflicts,
+            {current_user.id},
+            event.start,
+            event.end,
+            event.recurrence or None,
+        )
+        user = await session.scalar(select(User).where(User.id == current_user.id))
+
+        new_event = Event(
+            title=event.title,
+            description=event.description,
+            start=event.start,
+            end=event.end,
+            recurrence=event.recurrence or None,
+            series_end=last_end,
+            owner=user,
+        )
+        session.add(new_event)
+        await session.flush()
+        await bump_calendar_versions(session, [new_event.id])
+        await refresh_agenda(session, [new_event.id])
+        await session.commit()
+    return SavedEvent(conflicts=found)
 
 
 class EditInfo(BaseModel):
+    event_id: UUID | None = None
     title: str | None = None
     description: str | None = None
     start: int | None = None
     end: int | None = None
+    # An empty string makes the event non-recurring
+    recurrence: str | None = None
 
+    _check_recurrence = field_validator("recurrence")(check_recurrence)
 
-@router.post("/event/edit")
-def edit_event(
-    edit_info: EditInfo, current_user: Annotated[UserData, Depends(get_current_user)]
-) -> SuccessResponse:
-    args_pruned = {
-        key: value for key, value in edit_info.__dict__.items() if value is not None
+    def changes(self) -> dict:
+        changes = self.model_dump(exclude={"event_id"}, exclude_none=True)
+        if changes.get("recurrence") == "":
+            changes["recurrence"] = None
+        return changes
+
+
+def retimed(event: Event | Row, changes: dict) -> dict:
+    """Add the recomputed series_end to changes that affect an event's timing."""
+    if {"start", "end", "recurrence"}.isdisjoint(changes):
+        return changes
+    merged = {
+        "start": event.start,
+        "end": event.end,
+        "recurrence": event.recurrence,
+    } | changes
+    return changes | {
+        "series_end": checked_series_end(
+            merged["start"], merged["end"], merged["recurrence"]
+        )
     }
 
-    session: Session
-    with DBSession() as session:
-        event = session.scalar(select(Event).where(Event.owner_id == current_user.id))
+
+def resets_overrides(changes: dict) -> bool:
+    # Overrides are keyed by occurrence start and kept within series_end, which
+    # any of these changes can move
+    return not {"start", "end", "recurrence"}.isdisjoint(changes)
+
+
+@router.post("/event/edit")
+async def edit_event(
+    edit_info: EditInfo,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+    conflicts: ConflictMode = "ignore",
+) -> SavedEvent:
+    args_pruned = edit_info.changes()
+
+    query = select(Event).where(Event.owner_id == current_user.id)
+    if edit_info.event_id is not None:
+        query = query.where(Event.id == edit_info.event_id)
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        event = await session.scalar(query)
         if not event:
             raise EventNotOwnedException
-        session.execute(update(Event).where(Event.id == event.id).values(**args_pruned))
-        session.commit()
+        changes = retimed(event, args_pruned)
 
-    return SuccessResponse()
+        found = []
+        if "series_end" in changes:
+            attendees = await session.scalars(
+                select(user_event_association.c.user_id).where(
+                    user_event_association.c.event_id == event.id
+                )
+            )
+            found = await check_conflicts(
+                session,
+                conflicts,
+                {event.owner_id, *attendees},
+                changes.get("start", event.start),
+                changes.get("end", event.end),
+                changes.get("recurrence", event.recurrence),
+                exclude=event.id,
+            )
+
+        await session.execute(
+            update(Event).where(Event.id == event.id).values(**changes)
+        )
+        if resets_overrides(args_pruned):
+            await session.execute(
+                delete(OccurrenceOverride).where(
+                    OccurrenceOverride.event_id == event.id
+                )
+            )
+        await bump_calendar_versions(session, [event.id])
+        await refresh_agenda(session, [event.id])
+        await session.commit()
+
+    return SavedEvent(conflicts=found)
+
+
+async def event_owner(session: AsyncSession, event_id: UUID) -> UUID:
+    owner_id = await session.scalar(select(Event.owner_id).where(Event.id == event_id))
+    if owner_id is None:
+        raise DoesNotExistException(Event)
+    return owner_id
+
+
+async def add_attendees(
+    session: AsyncSession, event_id: UUID, usernames: Set[str]
+) -> Set[str]:
+    """Add users to an event by username, returning the usernames that don't exist.
+
+    Writes the association rows directly instead of loading the attendee collection,
+    and skips users who are already attending.
+    """
+    found = dict(
+        (
+            await session.execute(
+                select(User.username, User.id).where(User.username.in_(usernames))
+            )
+        ).all()
+    )
+    if found:
+        await session.execute(
+            pg_insert(user_event_association)
+            .values(
+                [
+                    {"user_id": user_id, "event_id": event_id}
+                    for user_id in found.values()
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+        await bump_calendar_versions(session, [event_id])
+        await refresh_agenda(session, [event_id])
+    return usernames - found.keys()
+
+
+async def remove_attendees(
+    session: AsyncSession, event_id: UUID, user_ids: Set[UUID]
+) -> None:
+    # Bump first so the users being removed still see the change
+    await bump_calendar_versions(session, [event_id])
+    await session.execute(
+        delete(user_event_association).where(
+            user_event_association.c.event_id == event_id,
+            user_event_association.c.user_id.in_(user_ids),
+        )
+    )
+    await refresh_agenda(session, [event_id])
 
 
 class RemoveAttendeeInfo(BaseModel):
@@ -115,33 +951,18 @@ class RemoveAttendeeInfo(BaseModel):
 
 
 @router.post("/event/attendees/remove")
-def remove_attendee(
+async def remove_attendee(
     info: RemoveAttendeeInfo,
     current_user: Annotated[UserData, Depends(get_current_user)],
 ):
-    session: Session
-    with DBSession() as session:
-        event: Event = session.scalar(
-            select(Event)
-            .where(Event.id == info.event_id)
-            .options(lazyload(Event.attendees))
-        )
-
-        if event:
-            if (
-                event.owner_id != current_user.id
-                and info.removing_attendee != current_user.id
-            ):
-                raise EventNotOwnedException
-            event.attendees = [
-                attendee
-                for attendee in event.attendees
-                if attendee.id != info.removing_attendee
-            ]
-            session.commit()
-            return {"status": "success"}
-
-        raise DoesNotExistException(Event)
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        owner_id = await event_owner(session, info.event_id)
+        if owner_id != current_user.id and info.removing_attendee != current_user.id:
+            raise EventNotOwnedException
+        await remove_attendees(session, info.event_id, {info.removing_attendee})
+        await session.commit()
+        return {"status": "success"}
 
 
 class AddAttendeeInfo(BaseModel):
@@ -150,32 +971,65 @@ class AddAttendeeInfo(BaseModel):
 
 
 @router.post("/event/attendees/add")
-def add_attendee(
+async def add_attendee(
     info: AddAttendeeInfo,
     current_user: Annotated[UserData, Depends(get_current_user)],
 ) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        event: Event = session.scalar(
-            select(Event)
-            .where(Event.id == info.event_id)
-            .options(lazyload(Event.attendees))
-        )
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        if await event_owner(session, info.event_id) != current_user.id:
+            raise EventNotOwnedException
+        if await add_attendees(session, info.event_id, {info.new_attendee}):
+            raise DoesNotExistException(User)
+        await session.commit()
+        return SuccessResponse()
 
-        if event:
-            if event.owner_id != current_user.id:
-                raise EventNotOwnedException
 
-            attendee = session.scalar(
-                select(User).where(User.username == info.new_attendee)
-            )
-            if not attendee:
-                raise DoesNotExistException(User)
-            event.attendees.append(attendee)
-            session.commit()
-            return SuccessResponse()
+MAX_BULK_ATTENDEES = 1000
 
-        raise DoesNotExistException(Event)
+
+class BulkAddAttendeesInfo(BaseModel):
+    event_id: UUID
+    usernames: Set[str] = Field(max_length=MAX_BULK_ATTENDEES)
+
+
+class BulkAddAttendeesResult(BaseModel):
+    missing: List[str]
+
+
+@router.post("/event/attendees/add/bulk")
+async def add_attendees_bulk(
+    info: BulkAddAttendeesInfo,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> BulkAddAttendeesResult:
+    """Invite many users at once. Unknown usernames are reported, not fatal."""
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        if await event_owner(session, info.event_id) != current_user.id:
+            raise EventNotOwnedException
+        missing = await add_attendees(session, info.event_id, info.usernames)
+        await session.commit()
+        return BulkAddAttendeesResult(missing=sorted(missing))
+
+
+class BulkRemoveAttendeesInfo(BaseModel):
+    event_id: UUID
+    attendees: Set[UUID] = Field(max_length=MAX_BULK_ATTENDEES)
+
+
+@router.post("/event/attendees/remove/bulk")
+async def remove_attendees_bulk(
+    info: BulkRemoveAttendeesInfo,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> SuccessResponse:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        if await event_owner(session, info.event_id) != current_user.id:
+            raise EventNotOwnedException
+        if info.attendees:
+            await remove_attendees(session, info.event_id, info.attendees)
+            await session.commit()
+        return SuccessResponse()
 
 
 class DeleteEventInfo(BaseModel):
@@ -183,15 +1037,230 @@ class DeleteEventInfo(BaseModel):
 
 
 @router.post("/event/delete")
-def delete_event(
+async def delete_event(
     info: DeleteEventInfo, current_user: Annotated[UserData, Depends(get_current_user)]
 ):
-    session: Session
-    with DBSession() as session:
-        event = session.get(Event, info.event_id)
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        event = await session.get(Event, info.event_id)
         if not event:
             raise DoesNotExistException(Event)
         if event.owner_id != current_user.id:
             raise EventNotOwnedException
-        session.delete(event)
-        session.commit()
+        await bump_calendar_versions(session, [event.id])
+        await session.delete(event)
+        await session.commit()
+
+
+class BatchCreate(NewEvent):
+    op: Literal["create"]
+
+
+class BatchEdit(EditInfo):
+    op: Literal["edit"]
+    event_id: UUID
+
+
+class BatchDelete(BaseModel):
+    op: Literal["delete"]
+    event_id: UUID
+
+
+BatchOperation = Annotated[
+    Union[BatchCreate, BatchEdit, BatchDelete], Field(discriminator="op")
+]
+
+MAX_BATCH_OPERATIONS = 5000
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(max_length=MAX_BATCH_OPERATIONS)
+
+
+class BatchResult(BaseModel):
+    event_id: UUID | None
+    status: Literal["ok", "not_found", "not_owned", "skipped"]
+
+
+class BatchResponse(BaseModel):
+    applied: bool
+    results: List[BatchResult]
+
+
+@router.post("/event/batch")
+async def batch_events(
+    batch: BatchRequest,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> BatchResponse:
+    """Apply many creates, edits and deletes atomically.
+
+    Ownership of every referenced event is checked up front in one query. If any
+    operation fails that check nothing is written, and the results say which ones
+    failed; otherwise all operations are applied in a single transaction.
+    """
+    operations = batch.operations
+    referenced = {op.event_id for op in operations if not isinstance(op, BatchCreate)}
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        existing = {
+            row.id: row
+            for row in await session.execute(
+                select(
+                    Event.id, Event.owner_id, Event.start, Event.end, Event.recurrence
+                ).where(Event.id.in_(referenced))
+            )
+        }
+
+        results: List[BatchResult] = []
+        for op in operations:
+            if isinstance(op, BatchCreate):
+                results.append(BatchResult(event_id=uuid4(), status="ok"))
+            elif op.event_id not in existing:
+                results.append(BatchResult(event_id=op.event_id, status="not_found"))
+            elif existing[op.event_id].owner_id != current_user.id:
+                results.append(BatchResult(event_id=op.event_id, status="not_owned"))
+            else:
+                results.append(BatchResult(event_id=op.event_id, status="ok"))
+
+        if any(result.status != "ok" for result in results):
+            for op, result in zip(operations, results):
+                if result.status == "ok":
+                    result.status = "skipped"
+                    if isinstance(op, BatchCreate):
+                        result.event_id = None
+            return BatchResponse(applied=False, results=results)
+
+        creates = [
+            {
+                "id": result.event_id,
+                "owner_id": current_user.id,
+                **op.model_dump(exclude={"op", "recurrence"}),
+                "recurrence": op.recurrence or None,
+                "series_end": checked_series_end(
+                    op.start, op.end, op.recurrence or None
+                ),
+            }
+            for op, result in zip(operations, results)
+            if isinstance(op, BatchCreate)
+        ]
+        changes: Dict[UUID, dict] = {}
+        for op in operations:
+            if isinstance(op, BatchEdit) and op.changes():
+                changes.setdefault(op.event_id, {}).update(op.changes())
+        edits = [
+            {"id": event_id, **retimed(existing[event_id], event_changes)}
+            for event_id, event_changes in changes.items()
+        ]
+        retimed_ids = [
+            event_id
+            for event_id, event_changes in changes.items()
+            if resets_overrides(event_changes)
+        ]
+        deletes = [op.event_id for op in operations if isinstance(op, BatchDelete)]
+
+        if creates:
+            await session.execute(insert(Event), creates)
+        if edits:
+            await session.execute(update(Event), edits)
+        if retimed_ids:
+            await session.execute(
+                delete(OccurrenceOverride).where(
+                    OccurrenceOverride.event_id.in_(retimed_ids)
+                )
+            )
+        # After writing new events but before deleting old ones, so both are covered
+        await bump_calendar_versions(
+            session, [row["id"] for row in creates + edits] + deletes
+        )
+        if deletes:
+            await session.execute(delete(Event).where(Event.id.in_(deletes)))
+        await refresh_agenda(session, [row["id"] for row in creates + edits])
+        await session.commit()
+
+    return BatchResponse(applied=True, results=results)
+
+
+class OccurrenceInfo(BaseModel):
+    event_id: UUID
+    # Original start of the occurrence
+    occurrence: Timestamp
+
+
+class OccurrenceEditInfo(OccurrenceInfo):
+    title: str | None = None
+    description: str | None = None
+    start: Timestamp | None = None
+    end: Timestamp | None = None
+
+
+async def save_override(
+    session: AsyncSession, current_user: UserData, info: OccurrenceInfo, **values
+) -> None:
+    event = await session.get(Event, info.event_id)
+    if not event:
+        raise DoesNotExistException(Event)
+    if event.owner_id != current_user.id:
+        raise EventNotOwnedException
+    if event.recurrence is None:
+        raise NotRecurringException
+    try:
+        found = is_occurrence(event.start, event.end, event.recurrence, info.occurrence)
+    except ValueError:
+        # Stored before the rule subset was narrowed
+        raise InvalidRecurrenceException
+    if not found:
+        raise NoSuchOccurrenceException
+    # Moved occurrences must stay where visible_events will look for the series
+    moved_start = info.occurrence if values.get("start") is None else values["start"]
+    moved_end = (
+        moved_start + event.end - event.start
+        if values.get("end") is None
+        else values["end"]
+    )
+    if moved_start < event.start or (
+        event.series_end is not None and moved_end > event.series_end
+    ):
+        raise OccurrenceOutsideSeriesException
+
+    await session.execute(
+        pg_insert(OccurrenceOverride)
+        .values(event_id=event.id, occurrence=info.occurrence, **values)
+        .on_conflict_do_update(
+            index_elements=[OccurrenceOverride.event_id, OccurrenceOverride.occurrence],
+            set_=values,
+        )
+    )
+    await bump_calendar_versions(session, [event.id])
+    await refresh_agenda(session, [event.id])
+    await session.commit()
+
+
+@router.post("/event/occurrence/cancel")
+async def cancel_occurrence(
+    info: OccurrenceInfo, current_user: Annotated[UserData, Depends(get_current_user)]
+) -> SuccessResponse:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        await save_override(session, current_user, info, cancelled=True)
+    return SuccessResponse()
+
+
+@router.post("/event/occurrence/edit")
+async def edit_occurrence(
+    info: OccurrenceEditInfo,
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> SuccessResponse:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        await save_override(
+            session,
+            current_user,
+            info,
+            cancelled=False,
+            title=info.title,
+            description=info.description,
+            start=info.start,
+            end=info.end,
+        )
+    return SuccessResponse()
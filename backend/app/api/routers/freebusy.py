@@ -0,0 +1,150 @@
+from typing import Annotated, List, Set, Tuple
+from uuid import UUID
+
+import intervals
+import numpy as np
+from api.exceptions import InvalidWindowException
+from database.calendar import calendar_entries, in_window, occurrence_times
+from database.database import AsyncDBSession, Event, User
+from fastapi import APIRouter, Depends
+from models import UserData, UserInfo
+from pydantic import BaseModel, Field
+from recurrence import TIME_RANGE
+from security.access import get_current_user
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+router = APIRouter()
+
+MAX_FREEBUSY_USERS = 500
+
+
+class FreeBusyQuery(BaseModel):
+    user_ids: Set[UUID] = Field(default=set(), max_length=MAX_FREEBUSY_USERS)
+    usernames: Set[str] = Field(default=set(), max_length=MAX_FREEBUSY_USERS)
+    # Compared with the int4 time columns, which can't hold other times
+    start: int = Field(ge=TIME_RANGE.start, le=TIME_RANGE.stop - 1)
+    end: int = Field(ge=TIME_RANGE.start, le=TIME_RANGE.stop - 1)
+    # Shorter gaps between busy intervals aren't reported as free
+    min_free: int = 0
+
+
+class UserBusy(BaseModel):
+    user: UserInfo
+    # [start, end) pairs, sorted and non-overlapping
+    busy: List[Tuple[int, int]]
+
+
+class FreeBusy(BaseModel):
+    users: List[UserBusy]
+    free: List[Tuple[int, int]]
+    # Requested ids and usernames that don't belong to any user
+    missing: List[str]
+
+
+def to_pairs(starts: np.ndarray, ends: np.ndarray) -> List[Tuple[int, int]]:
+    return np.column_stack((starts, ends)).tolist()
+
+
+@router.post("/freebusy")
+async def get_free_busy(
+    query: FreeBusyQuery, current_user: Annotated[UserData, Depends(get_current_user)]
+) -> FreeBusy:
+    """Busy intervals of each user and the slots in the window when all are free.
+
+    A user is busy during the events they own or attend, the same ones they see in
+    their own calendar. Only the times are disclosed, never what the events are.
+    """
+    if query.end <= query.start:
+        raise InvalidWindowException
+    window = (query.start, query.end)
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        users = (
+            await session.execute(
+                select(User.id, User.username)
+                .where(
+                    or_(User.id.in_(query.user_ids), User.username.in_(query.usernames))
+                )
+                .order_by(User.username)
+            )
+        ).all()
+        user_index = {user.id: index for index, user in enumerate(users)}
+
+        # Owned and attended events of every user in one round trip, aggregated into
+        # an array per user so the driver decodes a few hundred rows, not every event
+        candidates = calendar_entries(user_index, *in_window(*window)).subquery()
+        single = candidates.c.recurrence.is_(None)
+        calendars = (
+            await session.execute(
+                select(
+                    candidates.c.user_id,
+                    func.array_agg(candidates.c.start).filter(single),
+                    func.array_agg(candidates.c.end).filter(single),
+                    func.array_agg(candidates.c.id).filter(~single),
+                ).group_by(candidates.c.user_id)
+            )
+        ).all()
+
+        groups, starts, ends = [], [], []
+        series_users = {}
+        for user_id, user_starts, user_ends, series_ids in calendars:
+            if user_starts:
+                groups.append(np.full(len(user_starts), user_index[user_id]))
+                starts.append(np.array(user_starts, dtype=np.int64))
+                ends.append(np.array(user_ends, dtype=np.int64))
+            for series_id in series_ids or ():
+                series_users.setdefault(series_id, []).append(user_index[user_id])
+
+        if series_users:
+            series = await session.scalars(
+                select(Event)
+                .where(Event.id.in_(series_users))
+                .options(selectinload(Event.overrides))
+            )
+            for event in series:
+                times = np.array(
+                    [
+                        (start, end)
+                        for _, start, end, _ in occurrence_times(
+                            event, event.overrides, *window
+                        )
+                    ],
+                    dtype=np.int64,
+                ).reshape(-1, 2)
+                for group in series_users[event.id]:
+                    groups.append(np.full(len(times), group))
+                    starts.append(times[:, 0])
+                    ends.append(times[:, 1])
+
+    busy_groups, busy_starts, busy_ends = intervals.merge_groups(
+        np.concatenate(groups) if groups else np.empty(0, np.int64),
+        np.concatenate(starts) if starts else np.empty(0, np.int64),
+        np.concatenate(ends) if ends else np.empty(0, np.int64),
+        window,
+    )
+    free_starts, free_ends = intervals.gaps(
+        *intervals.merge(busy_starts, busy_ends), window, query.min_free
+    )
+
+    bounds = np.searchsorted(busy_groups, np.arange(len(users) + 1))
+    found = {str(user.id) for user in users} | {user.username for user in users}
+    return FreeBusy(
+        users=[
+            UserBusy(
+                user=UserInfo(id=user.id, username=user.username),
+                busy=to_pairs(
+                    busy_starts[bounds[index] : bounds[index + 1]],
+                    busy_ends[bounds[index] : bounds[index + 1]],
+                ),
+            )
+            for index, user in enumerate(users)
+        ],
+        free=to_pairs(free_starts, free_ends),
+        missing=sorted(
+            {str(user_id) for user_id in query.user_ids} - found
+            | query.usernames - found
+        ),
+    )
@@ -1,12 +1,25 @@
 from typing import Annotated
-
-from database.database import DBSession, User
+from uuid import UUID
+
+from api.agenda import refresh_agenda
+from database.calendar import bump_calendar_versions
+from database.database import (
+    ArchivedEvent,
+    AsyncDBSession,
+    Event,
+    User,
+    archived_attendance,
+    user_event_association,
+)
 from fastapi import APIRouter, Depends, HTTPException, status
 from models import SuccessResponse, UserData
 from pydantic import BaseModel, EmailStr, SecretStr
 from security.access import authenticate_user, get_current_user, get_hash
-from sqlalchemy import delete, select, update
-from sqlalchemy.orm import Session
+from database.pubsub import broker
+from security.cache import email_key, taken_names, username_key
+from sqlalchemy import CompoundSelect, delete, select, union, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter()
 
@@ -22,121 +35,183 @@ class UserProfile(BaseModel):
     username: str
 
 
+def taken_exception(error: IntegrityError) -> HTTPException:
+    """The conflict response for a write rejected by a unique index on users."""
+    if "ix_users_email" in str(error.orig):
+        return HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already in use")
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username taken")
+
+
+def events_seen_by(user_id: UUID) -> CompoundSelect:
+    """Ids of the events the user owns or attends, live or archived, all of which embed
+    their username."""
+    return union(
+        select(Event.id).where(Event.owner_id == user_id),
+        select(user_event_association.c.event_id).where(
+            user_event_association.c.user_id == user_id
+        ),
+        select(ArchivedEvent.id).where(ArchivedEvent.owner_id == user_id),
+        select(archived_attendance.c.event_id).where(archived_attendance.c.user_id == user_id),
+    )
+
+
 @router.post("/user/me")
-def get_profile(current_user: Annotated[UserData, Depends(get_current_user)]) -> UserProfile:
+async def get_profile(current_user: Annotated[UserData, Depends(get_current_user)]) -> UserProfile:
     return UserProfile(email=current_user.email, username=current_user.username)
 
 
 @router.post("/user/new")
-def create_user(info: NewUserInfo) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        id_in_db = (
-            session.scalar(select(User.username).where(User.username == info.username)) is not None
+async def create_user(info: NewUserInfo) -> SuccessResponse:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        # Names the filter hasn't seen are free without asking; if a concurrent signup
+        # takes one first, the unique indexes reject the commit below
+        id_in_db = username_key(info.username) in taken_names and (
+            await session.scalar(select(User.username).where(User.username == info.username))
+            is not None
         )
         if id_in_db:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username taken")
 
-        email_in_db = (
-            session.scalar(select(User.email).where(User.email == info.email)) is not None
+        email_in_db = email_key(info.email) in taken_names and (
+            await session.scalar(select(User.email).where(User.email == info.email)) is not None
         )
         if email_in_db:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT, detail="Email already in use"
-            )
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already in use")
 
         session.add(
             User(
                 email=info.email,
                 username=info.username,
-                password_hash=get_hash(info.password.get_secret_value()),
+                password_hash=await get_hash(info.password.get_secret_value()),
             )
         )
+        await broker.publish_names(session, [username_key(info.username), email_key(info.email)])
 
-        session.commit()
+        try:
+            await session.commit()
+        except IntegrityError as error:
+            # A concurrent signup took the username or email after the checks above
+            raise taken_exception(error)
     return SuccessResponse()
 
 
 @router.post("/user/delete")
-def delete_user(current_user: Annotated[UserData, Depends(get_current_user)]) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        session.execute(delete(User).where(User.id == current_user.id))
-        session.commit()
+async def delete_user(
+    current_user: Annotated[UserData, Depends(get_current_user)],
+) -> SuccessResponse:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        attended = (
+            await session.scalars(
+                select(user_event_association.c.event_id).where(
+                    user_event_association.c.user_id == current_user.id
+                )
+            )
+        ).all()
+        # Before the delete, while the owned events' attendees can still be found
+        await bump_calendar_versions(session, events_seen_by(current_user.id), archived=True)
+        await session.execute(delete(User).where(User.id == current_user.id))
+        # The owned events are gone, the others have lost an attendee
+        await refresh_agenda(session, attended)
+        await broker.publish_user_changes(session, [current_user.id])
+        await session.commit()
     return SuccessResponse()
 
 
 @router.post("/user/username/check")
-def check_username_availability(username: str) -> bool:
-    session: Session
-    with DBSession() as session:
+async def check_username_availability(username: str) -> bool:
+    if username_key(username) not in taken_names:
+        return True
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
         username_in_db = (
-            session.execute(select(User.username).where(User.username == username)).one_or_none()
-            is not None
-        )
+            await session.execute(select(User.username).where(User.username == username))
+        ).one_or_none() is not None
         return not username_in_db  # Available if not in db, not available if is in db
 
 
 @router.post("/user/email/check")
-def check_email_availability(email: EmailStr) -> bool:
-    session: Session
-    with DBSession() as session:
+async def check_email_availability(email: EmailStr) -> bool:
+    if email_key(email) not in taken_names:
+        return True
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
         email_in_db = (
-            session.execute(select(User.email).where(User.email == email)).one_or_none()
-            is not None
-        )
+            await session.execute(select(User.email).where(User.email == email))
+        ).one_or_none() is not None
         return not email_in_db
 
 
 @router.post("/user/username/edit")
-def change_username(
+async def change_username(
     new_username: str, current_user: Annotated[UserData, Depends(get_current_user)]
 ) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        username_in_db = (
-            session.scalar(select(User.username).where(User.username == new_username)) is not None
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        username_in_db = username_key(new_username) in taken_names and (
+            await session.scalar(select(User.username).where(User.username == new_username))
+            is not None
         )
         if username_in_db:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username taken")
 
-        session.execute(
-            update(User).where(User.id == current_user.id).values(username=new_username)
-        )
-        session.commit()
+        try:
+            await session.execute(
+                update(User).where(User.id == current_user.id).values(username=new_username)
+            )
+        except IntegrityError as error:
+            raise taken_exception(error)
+        await broker.publish_names(session, [username_key(new_username)])
+        await bump_calendar_versions(session, events_seen_by(current_user.id), archived=True)
+        await refresh_agenda(session, events_seen_by(current_user.id))
+        await broker.publish_user_changes(session, [current_user.id])
+        await session.commit()
 
     return SuccessResponse()
 
 
 @router.post("/user/email/edit")
-def change_email(
+async def change_email(
     new_email: str, current_user: Annotated[UserData, Depends(get_current_user)]
 ) -> SuccessResponse:
-    session: Session
-    with DBSession() as session:
-        email_in_db = session.scalar(select(User.email).where(User.email == new_email)) is not None
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        email_in_db = email_key(new_email) in taken_names and (
+            await session.scalar(select(User.email).where(User.email == new_email)) is not None
+        )
         if email_in_db:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT, detail="Email already in use"
-            )
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already in use")
 
-        session.execute(update(User).where(User.id == current_user.id).values(email=new_email))
-        session.commit()
+        try:
+            await session.execute(
+                update(User).where(User.id == current_user.id).values(email=new_email)
+            )
+        except IntegrityError as error:
+            raise taken_exception(error)
+        await broker.publish_names(session, [email_key(new_email)])
+        await broker.publish_user_changes(session, [current_user.id])
+        await session.commit()
     return SuccessResponse()
 
 
 @router.post("/user/password/edit")
-def change_password(
+async def change_password(
     new_password: SecretStr,
     old_password: SecretStr,
     current_user: Annotated[UserData, Depends(get_current_user)],
 ) -> SuccessResponse:
-    authenticate_user(current_user.username, old_password.get_secret_value())
-
-    session: Session
-    with DBSession() as session:
-        session.execute(
-            update(User).where(User.id == current_user.id).values(password=new_password)
+    await authenticate_user(current_user.username, old_password.get_secret_value())
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        await session.execute(
+            update(User)
+            .where(User.id == current_user.id)
+            .values(password_hash=await get_hash(new_password.get_secret_value()))
         )
-        session.commit()
+        await broker.publish_user_changes(session, [current_user.id])
+        await session.commit()
     return SuccessResponse()
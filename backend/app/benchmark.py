@@ -0,0 +1,565 @@
+"""Load test the API with a reproducible workload.
+
+Seeds an empty database with --users users owning --events events each, every event
+with --fan-out attendees and its agenda entries, starts the app under uvicorn and
+drives it from --clients concurrent clients for --duration seconds. Each client logs
+in as a seeded user and runs the operations of the --workload chosen from WORKLOADS,
+in its proportions:
+
+- mixed: logins, calendar reads, event creation and edits, attendee changes and
+  batches of --batch-size creates, deleted again by the client's next batch;
+- read: logins and calendar reads alone, which every version of the API serves, so
+  that running it against a checkout of an older commit with --app-dir compares the
+  two;
+- conflicts: moving events with their overlaps flagged, for calendars of 10k+ events
+  such as --users 4 --events 10000 make;
+- freebusy: free/busy of up to FREEBUSY_USERS seeded users over a week, for dense
+  calendars of 200 users.
+
+Throughput and p50/p95/p99 latency per route are printed, with what creating a
+batch's events cost in one batch and as single requests, and saved as JSON; pass an
+earlier result as --compare to see what changed, and the exit status is 1 if p95
+latency or throughput got worse by more than --tolerance. Needs httpx and db_url
+pointing at a scratch database:
+
+    db_url=postgresql://localhost/scratch python benchmark.py --output before.json
+    git worktree add /tmp/before <commit>
+    python benchmark.py --workload read --app-dir /tmp/before/backend/app
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import httpx
+import numpy as np
+from api.agenda import AGENDA_BATCH_SIZE, refresh_agenda
+from config.config import settings
+from database.database import (
+    AsyncDBSession,
+    Base,
+    Event,
+    User,
+    create_engines,
+    dispose_engines,
+    user_event_association,
+)
+from security.hashing import hash_context
+from sqlalchemy import Engine, func, select, text
+
+# Relative frequency of each operation in each workload
+WORKLOADS = {
+    "mixed": {
+        "login": 2,
+        "read": 10,
+        "page": 3,
+        "create": 3,
+        "edit": 3,
+        "attendees": 2,
+        "batch": 1,
+    },
+    "read": {"login": 2, "read": 10, "page": 3},
+    "conflicts": {"move": 1},
+    "freebusy": {"freebusy": 1},
+}
+# Users whose free/busy one request asks for
+FREEBUSY_USERS = 200
+PASSWORD = "benchmark"
+# Statuses of requests turned away by admission control, counted apart from errors
+SHED = (429, 503)
+# Event times are stored as int4
+BASE_TIME = 1_700_000_000
+SEED_SPAN = 90 * 24 * 60 * 60
+WINDOW = 7 * 24 * 60 * 60
+
+
+def seed(
+    engine: Engine, users: int, events: int, fan_out: int, rounds: int, rng: random.Random
+) -> dict:
+    """Insert the users and events, returning each user's name and owned event ids."""
+    password_hash = hash_context.copy(bcrypt__rounds=rounds).hash(PASSWORD)
+    user_ids = [uuid.uuid4() for _ in range(users)]
+    seeded_events = []
+    for owner_id in user_ids:
+        for _ in range(events):
+            start = BASE_TIME + rng.randrange(SEED_SPAN)
+            seeded_events.append(
+                {
+                    "id": uuid.uuid4(),
+                    "title": "Seeded event",
+                    "description": "Created by benchmark.py",
+                    "start": start,
+                    "end": start + rng.choice((1800, 3600, 7200)),
+                    "owner_id": owner_id,
+                    "recurrence": None,
+                }
+            )
+    for seeded in seeded_events:
+        seeded["series_end"] = seeded["end"]
+
+    with engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            [
+                {
+                    "id": user_id,
+                    "username": f"bench{index}",
+                    "email": f"bench{index}@example.com",
+                    "password_hash": password_hash,
+                }
+                for index, user_id in enumerate(user_ids)
+            ],
+        )
+        for batch in range(0, len(seeded_events), 10000):
+            chunk = seeded_events[batch : batch + 10000]
+            connection.execute(Event.__table__.insert(), chunk)
+            attendees = [
+                {"user_id": user_id, "event_id": seeded["id"]}
+                for seeded in chunk
+                for user_id in rng.sample(user_ids, min(fan_out, users))
+                if user_id != seeded["owner_id"]
+            ]
+            if attendees:
+                connection.execute(user_event_association.insert(), attendees)
+        connection.execute(text("ANALYZE"))
+
+    owned = defaultdict(list)
+    for seeded in seeded_events:
+        owned[seeded["owner_id"]].append(str(seeded["id"]))
+    return {
+        f"bench{index}": {"id": str(user_id), "events": owned[user_id]}
+        for index, user_id in enumerate(user_ids)
+    }
+
+
+async def build_agenda(users: dict) -> None:
+    """Render the seeded events' agenda entries, which GET /event reads by default."""
+    event_ids = [uuid.UUID(event_id) for user in users.values() for event_id in user["events"]]
+    for index in range(0, len(event_ids), AGENDA_BATCH_SIZE):
+        async with AsyncDBSession() as session:
+            await refresh_agenda(session, event_ids[index : index + AGENDA_BATCH_SIZE])
+            await session.commit()
+    async with AsyncDBSession() as session:
+        await session.execute(text("ANALYZE agenda_entries"))
+        await session.commit()
+    await dispose_engines()
+
+
+class Client:
+    """One simulated user, recording (route, status, seconds) for every request."""
+
+    def __init__(
+        self,
+        http: httpx.AsyncClient,
+        username: str,
+        users: dict,
+        rng: random.Random,
+        workload: Dict[str, int],
+        batch_size: int,
+    ):
+        self.http = http
+        self.username = username
+        self.user = users[username]
+        self.users = users
+        self.rng = rng
+        self.workload = workload
+        self.headers: Dict[str, str] = {}
+        self.added: List[Tuple[str, str]] = []
+        self.batch_size = batch_size
+        self.batched: List[str] = []
+        self.samples: List[Tuple[str, int, float]] = []
+
+    async def request(
+        self, method: str, route: str, label: str | None = None, **kwargs
+    ) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.http.request(method, route, headers=self.headers, **kwargs)
+        self.samples.append(
+            (label or f"{method} {route}", response.status_code, time.perf_counter() - started)
+        )
+        if response.status_code in SHED:
+            # Back off as asked, like a well-behaved client, rather than retrying at once
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+        return response
+
+    async def login(self) -> None:
+        response = await self.request(
+            "POST", "/token", data={"username": self.username, "password": PASSWORD}
+        )
+        if response.status_code == 200:
+            self.headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+
+    async def read(self) -> None:
+        start = BASE_TIME + self.rng.randrange(SEED_SPAN - WINDOW)
+        await self.request("GET", "/event", params={"start": start, "end": start + WINDOW})
+
+    async def page(self) -> None:
+        await self.request("GET", "/event/page", params={"limit": 50})
+
+    async def create(self) -> None:
+        start = BASE_TIME + self.rng.randrange(SEED_SPAN)
+        await self.request(
+            "POST",
+            "/event/new",
+            json={"title": "New event", "description": "", "start": start, "end": start + 3600},
+        )
+
+    async def edit(self) -> None:
+        if self.user["events"]:
+            await self.request(
+                "POST",
+                "/event/edit",
+                json={
+                    "event_id": self.rng.choice(self.user["events"]),
+                    "title": f"Edited {self.rng.randrange(1000)}",
+                },
+            )
+
+    async def move(self) -> None:
+        # Checks the event's new time against every calendar it is in
+        if self.user["events"]:
+            start = BASE_TIME + self.rng.randrange(SEED_SPAN)
+            await self.request(
+                "POST",
+                "/event/edit",
+                "POST /event/edit?conflicts=flag",
+                params={"conflicts": "flag"},
+                json={
+                    "event_id": self.rng.choice(self.user["events"]),
+                    "start": start,
+                    "end": start + 3600,
+                },
+            )
+
+    async def freebusy(self) -> None:
+        start = BASE_TIME + self.rng.randrange(SEED_SPAN - WINDOW)
+        await self.request(
+            "POST",
+            "/freebusy",
+            json={
+                "usernames": self.rng.sample(
+                    list(self.users), min(FREEBUSY_USERS, len(self.users))
+                ),
+                "start": start,
+                "end": start + WINDOW,
+            },
+        )
+
+    async def attendees(self) -> None:
+        # Alternate adding someone to one of our events and removing them again
+        if self.added:
+            event_id, user_id = self.added.pop()
+            await self.request(
+                "POST",
+                "/event/attendees/remove",
+                json={"event_id": event_id, "removing_attendee": user_id},
+            )
+        elif self.user["events"]:
+            event_id = self.rng.choice(self.user["events"])
+            username = self.rng.choice(list(self.users))
+            response = await self.request(
+                "POST",
+                "/event/attendees/add",
+                json={"event_id": event_id, "new_attendee": username},
+            )
+            if response.status_code == 200:
+                self.added.append((event_id, self.users[username]["id"]))
+
+    async def batch(self) -> None:
+        # Alternate creating a batch of events and deleting them again, in one request each
+        if self.batched:
+            await self.request(
+                "POST",
+                "/event/batch",
+                "POST /event/batch delete",
+                json={
+                    "operations": [
+                        {"op": "delete", "event_id": event_id} for event_id in self.batched
+                    ]
+                },
+            )
+            self.batched = []
+            return
+        operations = []
+        for _ in range(self.batch_size):
+            start = BASE_TIME + self.rng.randrange(SEED_SPAN)
+            operations.append(
+                {
+                    "op": "create",
+                    "title": "Batched event",
+                    "description": "",
+                    "start": start,
+                    "end": start + 3600,
+                }
+            )
+        response = await self.request(
+            "POST", "/event/batch", "POST /event/batch create", json={"operations": operations}
+        )
+        if response.status_code == 200:
+            self.batched = [result["event_id"] for result in response.json()["results"]]
+
+    async def run(self, until: float) -> None:
+        while not self.headers and time.perf_counter() < until:
+            await self.login()
+        operations = [getattr(self, name) for name in self.workload]
+        weights = list(self.workload.values())
+        while time.perf_counter() < until:
+            await self.rng.choices(operations, weights)[0]()
+
+
+def summarize(samples: List[Tuple[str, int, float]], duration: float) -> dict:
+    def stats(rows: List[Tuple[str, int, float]]) -> dict:
+        latencies = np.array([seconds for _, _, seconds in rows]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {
+            "requests": len(rows),
+            "errors": sum(status >= 400 and status not in SHED for _, status, _ in rows),
+            "shed": sum(status in SHED for _, status, _ in rows),
+            "throughput": round(len(rows) / duration, 1),
+            "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2),
+            "p99_ms": round(float(p99), 2),
+        }
+
+    by_route = defaultdict(list)
+    for sample in samples:
+        by_route[sample[0]].append(sample)
+    return {
+        "routes": {route: stats(rows) for route, rows in sorted(by_route.items())},
+        "total": stats(samples),
+    }
+
+
+def print_table(results: dict) -> None:
+    print(
+        f"{'route':34} {'requests':>9} {'errors':>7} {'shed':>6} {'req/s':>8}"
+        f" {'p50':>8} {'p95':>8} {'p99':>8}"
+    )
+    for route, row in [*results["routes"].items(), ("total", results["total"])]:
+        print(
+            f"{route:34} {row['requests']:9} {row['errors']:7} {row['shed']:6}"
+            f" {row['throughput']:8}"
+            f" {row['p50_ms']:8} {row['p95_ms']:8} {row['p99_ms']:8}"
+        )
+
+
+def print_batch_cost(results: dict, batch_size: int) -> None:
+    batched = results["routes"].get("POST /event/batch create")
+    single = results["routes"].get("POST /event/new")
+    if batched and single:
+        print(
+            f"\nCreating {batch_size} events at p50: {batched['p50_ms']} ms in one batch,"
+            f" {round(single['p50_ms'] * batch_size, 2)} ms as single requests"
+        )
+
+
+def compare(previous: dict, current: dict, tolerance: float) -> bool:
+    """Print the change per route; True if any p95 or throughput got worse by tolerance."""
+    regressed = False
+    print(f"\nCompared with {previous.get('commit')} from {previous.get('started_at')}:")
+    for route, row in [*current["routes"].items(), ("total", current["total"])]:
+        before = previous["routes"].get(route) if route != "total" else previous["total"]
+        if before is None:
+            continue
+        changes = []
+        for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+            change = (row[key] - before[key]) / before[key] if before[key] else 0.0
+            changes.append(f"{key} {before[key]} -> {row[key]} ({change:+.0%})")
+            worse = -change if key == "throughput" else change
+            if key in ("throughput", "p95_ms") and worse > tolerance:
+                regressed = True
+                changes[-1] += " REGRESSION"
+        print(f"{route:34} " + ", ".join(changes))
+    return regressed
+
+
+def git_commit(directory: str) -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(
+    port: int,
+    users: dict,
+    clients: int,
+    duration: float,
+    seed_value: int,
+    workload: Dict[str, int],
+    batch_size: int,
+):
+    rng = random.Random(seed_value)
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60
+    ) as http:
+        simulated = [
+            Client(
+                http,
+                rng.choice(list(users)),
+                users,
+                random.Random(rng.random()),
+                workload,
+                batch_size,
+            )
+            for _ in range(clients)
+        ]
+        started = time.perf_counter()
+        await asyncio.gather(*(client.run(started + duration) for client in simulated))
+        elapsed = time.perf_counter() - started
+    return [sample for client in simulated for sample in client.samples], elapsed
+
+
+def start_server(port: int, workers: int, rounds: int, app_dir: str) -> subprocess.Popen:
+    # Every simulated client shares one address, so per-client rate limits would
+    # throttle them as one
+    environment = dict(os.environ, bcrypt_rounds=str(rounds), rate_limits="false")
+    if workers > 1:
+        environment["pubsub_backend"] = "postgres"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "api.api:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--no-access-log",
+        ],
+        cwd=app_dir,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/ping", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("The server didn't start within two minutes")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the API with a workload.")
+    parser.add_argument("--workload", choices=WORKLOADS, default="mixed")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=50, help="events owned by each user")
+    parser.add_argument("--fan-out", type=int, default=3, help="attendees of each event")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--batch-size", type=int, default=1000, help="operations per batch")
+    parser.add_argument(
+        "--bcrypt-rounds",
+        type=int,
+        default=settings.bcrypt_rounds,
+        help="cost of password hashing, lower to keep logins from dominating a small machine",
+    )
+    parser.add_argument(
+        "--app-dir",
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help="backend/app directory of the checkout to serve, this one by default",
+    )
+    parser.add_argument("--port", type=int, default=8130)
+    parser.add_argument("--seed", type=int, default=0, help="random seed for data and load")
+    parser.add_argument("--output", default="benchmark.json", help="where to save results")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative p95 or throughput change counted as a regression",
+    )
+    args = parser.parse_args()
+
+    engine, _ = create_engines()
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        if connection.scalar(select(func.count()).select_from(User)):
+            print("benchmark.py seeds its own data and needs an empty database")
+            return 2
+    started = time.perf_counter()
+    users = seed(
+        engine, args.users, args.events, args.fan_out, args.bcrypt_rounds, random.Random(args.seed)
+    )
+    asyncio.run(build_agenda(users))
+    print(f"Seeded {args.users} users and {args.users * args.events} events", end=" ")
+    print(f"in {time.perf_counter() - started:.1f}s")
+
+    server = start_server(args.port, args.workers, args.bcrypt_rounds, args.app_dir)
+    try:
+        samples, elapsed = asyncio.run(
+            drive(
+                args.port,
+                users,
+                args.clients,
+                args.duration,
+                args.seed,
+                WORKLOADS[args.workload],
+                args.batch_size,
+            )
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = {
+        "commit": git_commit(args.app_dir),
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            name: getattr(args, name)
+            for name in (
+                "workload",
+                "users",
+                "events",
+                "fan_out",
+                "clients",
+                "duration",
+                "workers",
+                "batch_size",
+                "bcrypt_rounds",
+                "seed",
+            )
+        },
+        "duration": round(elapsed, 2),
+        **summarize(samples, elapsed),
+    }
+    print_table(results)
+    print_batch_cost(results, args.batch_size)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as earlier:
+            previous = json.load(earlier)
+        if previous.get("config") != results["config"]:
+            print("Warning: the compared run used a different configuration")
+        if compare(previous, results, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
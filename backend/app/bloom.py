@@ -0,0 +1,72 @@
+"""A Bloom filter: a compact set that can answer "definitely not present".
+
+Membership tests can return false positives at roughly the configured rate but never
+false negatives, and items can't be removed. Bulk loading hashes in Python but sets
+the bits with NumPy, so filling it from a whole table stays cheap.
+"""
+
+import hashlib
+import math
+from typing import Iterable, List
+
+import numpy as np
+
+UINT64 = 2**64
+
+
+def _hashes(item: str) -> tuple[int, int]:
+    digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+    # The second hash must be odd so that it steps through every bit position
+    return (
+        int.from_bytes(digest[:8], "little"),
+        int.from_bytes(digest[8:], "little") | 1,
+    )
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.reset(capacity, error_rate)
+
+    def reset(self, capacity: int, error_rate: float) -> None:
+        """Empty the filter, sizing it to hold capacity items at error_rate."""
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> List[int]:
+        first, second = _hashes(item)
+        return [
+            (first + index * second) % UINT64 % self.size
+            for index in range(self.hash_count)
+        ]
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, items: Iterable[str]) -> None:
+        digests = b"".join(
+            hashlib.blake2b(item.encode(), digest_size=16).digest() for item in items
+        )
+        hashes = np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+        first, second = hashes[:, 0], hashes[:, 1] | np.uint64(1)
+        # A view sharing memory with the bytearray, which is faster for single bits
+        bits = np.frombuffer(self._bits, dtype=np.uint8)
+        for index in range(self.hash_count):
+            # uint64 arithmetic wraps around just like the % UINT64 in _positions
+            positions = (first + np.uint64(index) * second) % np.uint64(self.size)
+            np.bitwise_or.at(
+                bits,
+                positions >> np.uint64(3),
+                np.left_shift(1, positions & np.uint64(7)).astype(np.uint8),
+            )
+        self.count += len(hashes)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
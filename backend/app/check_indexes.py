@@ -0,0 +1,283 @@
+"""Fail if any query the API runs can't be served by an index.
+
+Seeds an empty database, sends a request to every route through FastAPI's TestClient
+(which needs httpx) while recording the statements run to handle them, then EXPLAINs
+each one with sequential scans disabled. A Seq Scan that is still in a plan means no
+index can serve that query. Point db_url at a scratch database:
+
+    db_url=postgresql://localhost/scratch python check_indexes.py
+"""
+
+import asyncio
+import json
+import random
+import sys
+import time
+import uuid
+from typing import Dict, Iterator, List, Tuple
+
+from database.database import (
+    AsyncDBSession,
+    Base,
+    CalendarChange,
+    Event,
+    OccurrenceOverride,
+    User,
+    create_engines,
+    user_event_association,
+)
+from metrics import current_request
+from sqlalchemy import Engine, event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+SEED_USERS = 2000
+SEED_EVENTS = 20000
+SEED_ATTENDEES = 3
+SEED_SERIES = 500
+# Event times are stored as int4
+BASE_TIME = 1_700_000_000
+DAY = 24 * 60 * 60
+
+statements: Dict[str, object] = {}
+
+
+def record_statement(connection, cursor, statement, parameters, context, executemany):
+    # Startup, such as reading every name into taken_names, scans tables on purpose
+    if current_request.get() is None:
+        return
+    keyword = statement.lstrip().split(None, 1)[0].upper()
+    if keyword in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+
+def seed(engine: Engine) -> None:
+    rng = random.Random(0)
+    user_ids = [uuid.uuid4() for _ in range(SEED_USERS)]
+    events = [
+        {
+            "id": uuid.uuid4(),
+            "title": f"event {index}",
+            "description": "",
+            "start": BASE_TIME + index * 3600,
+            "end": BASE_TIME + index * 3600 + 1800,
+            "owner_id": rng.choice(user_ids),
+            "recurrence": None,
+            "series_end": BASE_TIME + index * 3600 + 1800,
+        }
+        for index in range(SEED_EVENTS)
+    ]
+    for series in events[:SEED_SERIES]:
+        series["recurrence"] = "FREQ=DAILY;COUNT=30"
+        series["series_end"] = series["end"] + 29 * DAY
+    with engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            [
+                {
+                    "id": user_id,
+                    "username": f"seed{index}",
+                    "email": f"seed{index}@example.com",
+                    "password_hash": "",
+                }
+                for index, user_id in enumerate(user_ids)
+            ],
+        )
+        connection.execute(Event.__table__.insert(), events)
+        connection.execute(
+            user_event_association.insert(),
+            [
+                {"user_id": user_id, "event_id": seeded["id"]}
+                for seeded in events
+                for user_id in rng.sample(user_ids, SEED_ATTENDEES)
+            ],
+        )
+        connection.execute(
+            OccurrenceOverride.__table__.insert(),
+            [
+                {"event_id": series["id"], "occurrence": series["start"] + DAY}
+                for series in events[:SEED_SERIES]
+            ],
+        )
+        connection.execute(
+            CalendarChange.__table__.insert(),
+            [
+                {"user_id": seeded["owner_id"], "version": index, "event_id": seeded["id"]}
+                for index, seeded in enumerate(events)
+            ],
+        )
+        connection.execute(text("ANALYZE"))
+
+
+def exercise_routes() -> None:
+    """Call every route with a request that reaches its queries."""
+    from api.api import app
+    from fastapi.testclient import TestClient
+
+    with TestClient(app) as client:
+
+        def call(method: str, url: str, expected: int = 200, **kwargs) -> dict:
+            response = client.request(method, url, headers=headers, **kwargs)
+            assert response.status_code == expected, (url, response.text)
+            return response.json() if "json" in response.headers["content-type"] else {}
+
+        headers: Dict[str, str] = {}
+        for name in ("planner", "guest"):
+            call(
+                "POST",
+                "/user/new",
+                json={"email": f"{name}@example.com", "username": name, "password": "pw"},
+            )
+        token = client.post("/token", data={"username": "planner", "password": "pw"})
+        headers = {"Authorization": "Bearer " + token.json()["access_token"]}
+        guest = call("POST", "/user/username/check", params={"username": "guest"})
+        assert guest is False
+
+        start = BASE_TIME + SEED_EVENTS * 3600
+        call(
+            "POST",
+            "/event/new",
+            params={"conflicts": "flag"},
+            json={"title": "t", "description": "", "start": start, "end": start + 3600},
+        )
+        call(
+            "POST",
+            "/event/new",
+            params={"conflicts": "flag"},
+            json={
+                "title": "s",
+                "description": "",
+                "start": start + DAY,
+                "end": start + DAY + 600,
+                "recurrence": "FREQ=WEEKLY;COUNT=10",
+            },
+        )
+        event_id, series_id = (event["id"] for event in call("GET", "/event"))
+        call("POST", "/event/attendees/add", json={"event_id": event_id, "new_attendee": "guest"})
+        call(
+            "POST",
+            "/event/attendees/add/bulk",
+            json={"event_id": series_id, "usernames": ["guest", "seed1"]},
+        )
+        guest_id = call("GET", "/event")[0]["attendees"][0]["id"]
+        window = {"start": BASE_TIME, "end": start + 30 * DAY}
+        for url, params in [
+            ("/event", window),
+            ("/event", window | {"format": "columnar"}),
+            ("/event/page", {"limit": 1}),
+            ("/event/changes", {}),
+            ("/event/changes", {"since": 1}),
+        ]:
+            call("GET", url, params=params)
+        call("GET", "/event/export.ics")
+        call(
+            "POST",
+            "/freebusy",
+            json={"usernames": ["planner", "guest", "seed1", "seed2"]} | window,
+        )
+        call(
+            "POST",
+            "/event/edit",
+            params={"conflicts": "reject"},
+            json={"event_id": event_id, "start": start + 60, "end": start + 7200},
+        )
+        call(
+            "POST",
+            "/event/occurrence/edit",
+            json={"event_id": series_id, "occurrence": start + DAY, "title": "moved"},
+        )
+        call(
+            "POST",
+            "/event/occurrence/cancel",
+            json={"event_id": series_id, "occurrence": start + DAY + 7 * DAY},
+        )
+        call(
+            "POST",
+            "/event/attendees/remove",
+            json={"event_id": event_id, "removing_attendee": guest_id},
+        )
+        call(
+            "POST",
+            "/event/attendees/remove/bulk",
+            json={"event_id": series_id, "attendees": [guest_id]},
+        )
+        call(
+            "POST",
+            "/event/batch",
+            json={
+                "operations": [
+                    {
+                        "op": "create",
+                        "title": "b",
+                        "description": "",
+                        "start": start,
+                        "end": start + 60,
+                    },
+                    {"op": "edit", "event_id": series_id, "title": "renamed"},
+                    {"op": "delete", "event_id": event_id},
+                ]
+            },
+        )
+        exported = client.get("/event/export.ics", headers=headers).content
+        call("POST", "/event/import.ics", files={"file": ("calendar.ics", exported)})
+        call("POST", "/event/delete", json={"event_id": series_id})
+        call("POST", "/user/me")
+        call("POST", "/user/email/check", params={"email": "guest@example.com"})
+        call("POST", "/user/username/edit", params={"new_username": "planner2"})
+        call("POST", "/user/email/edit", params={"new_email": "planner2@example.com"})
+        call("POST", "/user/password/edit", params={"new_password": "pw2", "old_password": "pw"})
+        call("POST", "/user/delete")
+
+
+def seq_scans(plan: dict) -> Iterator[str]:
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", ()):
+        yield from seq_scans(child)
+
+
+async def explain(async_engine: AsyncEngine) -> List[Tuple[str, List[str]]]:
+    failures = []
+    # The pooled connections belong to the TestClient's event loop, which is closed
+    await async_engine.dispose(close=False)
+    async with AsyncDBSession() as session:
+        connection = await session.connection()
+        await connection.exec_driver_sql("SET enable_seqscan = off")
+        for statement, parameters in statements.items():
+            result = await connection.exec_driver_sql(
+                "EXPLAIN (FORMAT JSON) " + statement, parameters
+            )
+            plan = result.scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            tables = sorted(set(seq_scans(plan[0]["Plan"])))
+            if tables:
+                failures.append((statement, tables))
+        await session.rollback()
+    return failures
+
+
+def main() -> int:
+    engine, async_engine = create_engines()
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        if connection.scalar(select(func.count()).select_from(User)):
+            print("check_indexes.py seeds its own data and needs an empty database")
+            return 2
+    started = time.perf_counter()
+    seed(engine)
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    for target in (engine, async_engine.sync_engine):
+        event.listen(target, "before_cursor_execute", record_statement)
+    exercise_routes()
+    for target in (engine, async_engine.sync_engine):
+        event.remove(target, "before_cursor_execute", record_statement)
+
+    failures = asyncio.run(explain(async_engine))
+    for statement, tables in failures:
+        print(f"Seq Scan on {', '.join(tables)}:\n{statement}\n")
+    print(f"{len(statements)} statements explained, {len(failures)} with sequential scans")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Fail if the number of statements a calendar read runs grows with its events.
+
+Creates two users through FastAPI's TestClient (which needs httpx), one with N events
+and one with 8N, each with attendees, recurring series with edited occurrences and
+an archived half. Then reads both calendars every way GET /event and /event/page can
+serve them, counting each request's statements with the counter metrics keeps per
+request. Any read whose count differs between the two calendars issues queries per
+event. Point db_url at a scratch database:
+
+    db_url=postgresql://localhost/scratch python check_queries.py
+"""
+
+import sys
+from typing import Dict, List, Tuple
+
+from config.config import settings
+from database.archive import archive_events
+from database.database import Base, User, create_engines
+from metrics import RequestStats, current_request
+from sqlalchemy import event, func, select
+
+EVENTS = 25
+SCALE = 8
+ATTENDEES = ["guest1", "guest2", "guest3"]
+# Event times are stored as int4
+BASE_TIME = 1_700_000_000
+DAY = 24 * 60 * 60
+
+# RequestStats of the requests that ran statements, most recent last
+requests: List[RequestStats] = []
+
+
+def record_request(connection, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+    if stats is not None and (not requests or requests[-1] is not stats):
+        requests.append(stats)
+
+
+def listed_events(payload: list | dict) -> int:
+    if isinstance(payload, list):
+        return len(payload)
+    events = payload["events"]
+    # Columnar payloads have an array per field
+    return len(events["id"] if isinstance(events, dict) else events)
+
+
+def main() -> int:
+    from api.api import app
+    from fastapi.testclient import TestClient
+
+    engine, async_engine = create_engines()
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        if connection.scalar(select(func.count()).select_from(User)):
+            print("check_queries.py creates its own data and needs an empty database")
+            return 2
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record_request)
+    # Every request comes from the TestClient's one address
+    settings.rate_limits = False
+
+    with TestClient(app) as client:
+
+        def call(method: str, url: str, headers: Dict[str, str], **kwargs) -> dict:
+            response = client.request(method, url, headers=headers, **kwargs)
+            assert response.status_code == 200, (url, response.text)
+            return response.json()
+
+        def create_user(name: str) -> Dict[str, str]:
+            call(
+                "POST",
+                "/user/new",
+                {},
+                json={"email": f"{name}@example.com", "username": name, "password": "pw"},
+            )
+            token = client.post("/token", data={"username": name, "password": "pw"})
+            return {"Authorization": "Bearer " + token.json()["access_token"]}
+
+        for name in ATTENDEES:
+            create_user(name)
+
+        def create_calendar(name: str, count: int) -> Dict[str, str]:
+            headers = create_user(name)
+            operations = [
+                {
+                    "op": "create",
+                    "title": f"event {index}",
+                    "description": "",
+                    "start": BASE_TIME + index * DAY,
+                    "end": BASE_TIME + index * DAY + 1800,
+                    # Every fourth a series, each with an edited occurrence
+                    "recurrence": "FREQ=DAILY;COUNT=3" if index % 4 == 0 else None,
+                }
+                for index in range(count)
+            ]
+            results = call("POST", "/event/batch", headers, json={"operations": operations})[
+                "results"
+            ]
+            for index, result in enumerate(results):
+                call(
+                    "POST",
+                    "/event/attendees/add/bulk",
+                    headers,
+                    json={"event_id": result["event_id"], "usernames": ATTENDEES},
+                )
+                if operations[index]["recurrence"] is not None:
+                    call(
+                        "POST",
+                        "/event/occurrence/edit",
+                        headers,
+                        json={
+                            "event_id": result["event_id"],
+                            "occurrence": operations[index]["start"] + DAY,
+                            "title": "moved",
+                        },
+                    )
+            return headers
+
+        calendars = [
+            (count, create_calendar(f"planner{count}", count)) for count in (EVENTS, SCALE * EVENTS)
+        ]
+        # The same first days of both, so each has live and archived events
+        client.portal.call(archive_events, BASE_TIME + EVENTS // 2 * DAY)
+
+        window = {"start": BASE_TIME, "end": BASE_TIME + (SCALE * EVENTS + 3) * DAY}
+        reads: List[Tuple[str, dict]] = [
+            ("/event/page", {"limit": 500}),
+            *(
+                ("/event", params | {"format": payload_format})
+                for params in ({}, window)
+                for payload_format in ("full", "compact", "columnar")
+            ),
+        ]
+        failures = 0
+        for agenda_reads in (True, False):
+            settings.agenda_reads = agenda_reads
+            for url, params in reads:
+                counts = []
+                for count, headers in calendars:
+                    # Once to cache the user, then the read that is counted
+                    call("GET", url, headers, params=params)
+                    requests.clear()
+                    listed = listed_events(call("GET", url, headers, params=params))
+                    counts.append(requests[-1].queries if requests else 0)
+                    assert listed >= count, (url, params, listed, count)
+                label = f"GET {url} {params} agenda_reads={agenda_reads}"
+                if len(set(counts)) > 1:
+                    failures += 1
+                    print(
+                        f"{label}: {counts[0]} statements at {EVENTS} events, "
+                        f"{counts[1]} at {SCALE * EVENTS}"
+                    )
+
+    print(f"{len(reads) * 2} reads checked, {failures} with statements per event")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
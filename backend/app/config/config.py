@@ -8,6 +8,46 @@ class Settings(BaseSettings):
     db_url: str = ""
     pass_key: str = ""
     is_ipv6: bool = False
+    user_cache_size: int = 4096
+    user_cache_ttl: float = 60.0
+    bcrypt_rounds: int = 12
+    hash_workers: int = 2
+    hash_queue_depth: int = 32
+    change_log_retention: int = 30 * 24 * 60 * 60
+    pubsub_backend: str = "local"  # "local" or "postgres" for multiple workers
+    conflict_horizon: int = 365 * 24 * 60 * 60  # How far ahead series are checked for conflicts
+    slow_request_threshold: float = 1.0  # Seconds before a request is logged with its SQL
+    taken_names_capacity: int = 1_000_000  # Usernames plus emails the filter is sized for
+    taken_names_error_rate: float = 0.01
+    create_schema: bool = True  # Create missing tables on startup, off if only Alembic may
+    db_pool_size: int = 5  # Per engine and worker process
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0  # Seconds to wait for a free pooled connection
+    db_pool_recycle: int = -1  # Seconds before a connection is replaced, -1 for never
+    db_pool_pre_ping: bool = False  # Test connections on checkout to survive dropped ones
+    db_connect_timeout: float = 10.0
+    workers: int = 0  # Worker processes in production mode, 0 for one per CPU
+    agenda_reads: bool = True  # Serve GET /event from agenda_entries, off until backfilled
+    archive_after: int = 0  # Seconds after a series ends before it is archived, 0 for never
+    # Admission control, per worker process. Password routes, large reads and the rest
+    # each have a limit on requests at once (503 beyond it) and a per-client rate (429)
+    hashing_concurrency: int = 8
+    hashing_rate: float = 0.5  # Requests per second a client may sustain
+    hashing_burst: int = 10
+    bulk_concurrency: int = 10
+    bulk_rate: float = 5.0
+    bulk_burst: int = 20
+    request_concurrency: int = 200
+    request_rate: float = 50.0
+    request_burst: int = 100
+    rate_limits: bool = True  # Off when all clients share an address, e.g. load tests
+    # Proxies trusted to name the client in X-Forwarded-For, as comma-separated addresses
+    # or "*". Rate limits are per client address, so behind a reverse proxy it must be
+    # listed here, or every client shares the proxy's limit. Only use "*" when nothing
+    # but the proxy can reach the API.
+    forwarded_allow_ips: str = "127.0.0.1"
+    rate_limit_clients: int = 100_000  # Client addresses tracked before idle ones go
+    busy_retry_after: int = 1  # Seconds in the Retry-After of 503s
 
     model_config: SettingsConfigDict = SettingsConfigDict(env_file=".env")
 
@@ -0,0 +1,208 @@
+"""Moving events whose series ended long ago out of the live tables, into the archive.
+
+The live events, attendance and override tables, and the indexes every request
+walks, then only hold events that can still change. The archive tables are range
+partitioned by month of series_end, with a partition per month created as it is
+first needed, so a read of a window only visits months that ended after the window
+starts. Archived events are read-only: edits and deletes answer as if they were
+gone, and they are removed only with their owner.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import timezone
+from typing import List
+
+from config.config import settings
+from database.database import (
+    ArchivedEvent,
+    ArchivedOccurrenceOverride,
+    AsyncDBSession,
+    Event,
+    OccurrenceOverride,
+    archived_attendance,
+    user_event_association,
+)
+from sqlalchemy import (
+    ColumnElement,
+    Table,
+    delete,
+    false,
+    func,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# Held by whichever worker is archiving, so that the others skip the run
+ARCHIVE_LOCK = 0x617263686976
+# Events moved per transaction, like AGENDA_BATCH_SIZE
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_TABLES: List[Table] = [
+    ArchivedEvent.__table__,
+    archived_attendance,
+    ArchivedOccurrenceOverride.__table__,
+]
+INT4_MIN, INT4_MAX = -(2**31), 2**31 - 1
+
+
+def archive_window(start: int | None, end: int | None) -> List[ColumnElement[bool]]:
+    """Conditions matching archived events overlapping [start, end), the same as
+    in_window matches live ones. Every archived event ends, and the condition on
+    series_end is what prunes partitions."""
+    if start is None and end is None:
+        return []
+    if start is not None and end is not None and start >= end:
+        return [false()]
+    # As with ranges, an event that takes no time overlaps nothing
+    conditions = [ArchivedEvent.start < ArchivedEvent.series_end]
+    if end is not None:
+        conditions.append(ArchivedEvent.start < end)
+    if start is not None:
+        conditions.append(ArchivedEvent.series_end > start)
+    return conditions
+
+
+def _bound(timestamp: int) -> str:
+    if timestamp <= INT4_MIN:
+        return "MINVALUE"
+    if timestamp > INT4_MAX:
+        return "MAXVALUE"
+    return str(timestamp)
+
+
+async def create_partitions(session: AsyncSession, cutoff: int) -> int:
+    """Create the missing partitions for every month with events to archive,
+    returning how many months needed them."""
+    month_start = func.date_trunc(
+        "month", func.timezone("UTC", func.to_timestamp(Event.series_end))
+    )
+    months = (
+        await session.scalars(
+            select(month_start).where(Event.series_end < cutoff).distinct()
+        )
+    ).all()
+    existing = set(
+        (
+            await session.scalars(
+                text(
+                    "SELECT inhrelid::regclass::text FROM pg_inherits "
+                    "WHERE inhparent = 'events_archive'::regclass"
+                )
+            )
+        ).all()
+    )
+    created = 0
+    for month in months:
+        suffix = month.strftime("y%Ym%m")
+        if f"events_archive_{suffix}" in existing:
+            continue
+        following = month.replace(
+            year=month.year + month.month // 12, month=month.month % 12 + 1
+        )
+        lower = _bound(int(month.replace(tzinfo=timezone.utc).timestamp()))
+        upper = _bound(int(following.replace(tzinfo=timezone.utc).timestamp()))
+        for table in ARCHIVE_TABLES:
+            await session.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {table.name}_{suffix} PARTITION OF "
+                    f"{table.name} FOR VALUES FROM ({lower}) TO ({upper})"
+                )
+            )
+        created += 1
+    return created
+
+
+async def archive_batch(session: AsyncSession, cutoff: int) -> int:
+    """Move up to ARCHIVE_BATCH_SIZE events whose series ended before cutoff,
+    returning how many were moved. Their partitions must already exist."""
+    event_ids = (
+        await session.scalars(
+            select(Event.id)
+            .where(Event.series_end < cutoff)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+    ).all()
+    if not event_ids:
+        return 0
+
+    columns = [column.name for column in Event.__table__.columns]
+    await session.execute(
+        insert(ArchivedEvent).from_select(
+            columns,
+            select(*Event.__table__.columns).where(Event.id.in_(event_ids)),
+        )
+    )
+    await session.execute(
+        insert(archived_attendance).from_select(
+            ["user_id", "event_id", "series_end"],
+            select(
+                user_event_association.c.user_id,
+                user_event_association.c.event_id,
+                Event.series_end,
+            )
+            .join(Event, Event.id == user_event_association.c.event_id)
+            .where(Event.id.in_(event_ids)),
+        )
+    )
+    override_columns = [column.name for column in OccurrenceOverride.__table__.columns]
+    await session.execute(
+        insert(ArchivedOccurrenceOverride).from_select(
+            override_columns + ["series_end"],
+            select(*OccurrenceOverride.__table__.columns, Event.series_end)
+            .join(Event, Event.id == OccurrenceOverride.event_id)
+            .where(Event.id.in_(event_ids)),
+        )
+    )
+    # Attendance, overrides and agenda entries go with the events. Nothing a user
+    # sees changes, so calendar versions stay as they are.
+    await session.execute(delete(Event).where(Event.id.in_(event_ids)))
+    return len(event_ids)
+
+
+async def archive_events(cutoff: int) -> int:
+    """Move every event whose series ended before cutoff to the archive, a batch
+    per transaction, returning how many were moved."""
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        if not await session.scalar(
+            select(func.pg_try_advisory_xact_lock(ARCHIVE_LOCK))
+        ):
+            return 0
+        # Adding a partition locks its parent, so this commits before any moves
+        if await create_partitions(session, cutoff):
+            await session.commit()
+
+    moved = 0
+    while True:
+        async with AsyncDBSession() as session:
+            if not await session.scalar(
+                select(func.pg_try_advisory_xact_lock(ARCHIVE_LOCK))
+            ):
+                break
+            count = await archive_batch(session, cutoff)
+            await session.commit()
+        if not count:
+            break
+        moved += count
+    if moved:
+        logger.info("Archived %d events that ended before %d", moved, cutoff)
+    return moved
+
+
+async def archive_old_events() -> None:
+    """Periodically archive events whose series ended over archive_after ago."""
+    while True:
+        if settings.archive_after:
+            try:
+                await archive_events(int(time.time()) - settings.archive_after)
+            except Exception:
+                # Such as an event edited to end in a month without a partition
+                # since they were created; the next run creates it
+                logger.exception("Archiving events failed")
+        await asyncio.sleep(60 * 60)
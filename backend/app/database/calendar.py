@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Collection, Iterable, Iterator, List, Sequence, Tuple
+from uuid import UUID
+
+from config.config import settings
+from database.pubsub import broker
+from database.database import (
+    ArchivedEvent,
+    AsyncDBSession,
+    CalendarChange,
+    Event,
+    OccurrenceOverride,
+    User,
+    archived_attendance,
+    event_span,
+    user_event_association,
+)
+from recurrence import occurrences, parse_rule
+from sqlalchemy import (
+    ColumnElement,
+    CompoundSelect,
+    Integer,
+    Row,
+    Select,
+    delete,
+    func,
+    insert,
+    literal,
+    select,
+    union,
+    union_all,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+logger = logging.getLogger(__name__)
+
+
+def calendar_etag(user_id: UUID, version: int) -> str:
+    return f'"{user_id}-{version}"'
+
+
+def in_window(start: int | None, end: int | None) -> List[ColumnElement[bool]]:
+    """Conditions matching events with any occurrence overlapping [start, end)."""
+    if start is None and end is None:
+        return []
+    if start is not None and end is not None:
+        end = max(start, end)
+    # Typed, as the bound for -2**31 would otherwise be a bigint, which int4range
+    # doesn't take
+    return [
+        event_span.op("&&")(
+            func.int4range(literal(start, Integer), literal(end, Integer))
+        )
+    ]
+
+
+def calendar_entries(
+    user_ids: Collection[UUID], *conditions: ColumnElement[bool]
+) -> CompoundSelect:
+    """(user_id, id, start, end, recurrence) of the events each user owns or attends."""
+    columns = (Event.id, Event.start, Event.end, Event.recurrence)
+    return union_all(
+        select(Event.owner_id.label("user_id"), *columns).where(
+            Event.owner_id.in_(user_ids), *conditions
+        ),
+        select(user_event_association.c.user_id, *columns)
+        .join(Event, Event.id == user_event_association.c.event_id)
+        .where(user_event_association.c.user_id.in_(user_ids), *conditions),
+    )
+
+
+def occurrence_times(
+    event: Event | Row,
+    overrides: Iterable[OccurrenceOverride | Row],
+    start: int | None,
+    end: int,
+) -> Iterator[Tuple[int, int, int, OccurrenceOverride | Row | None]]:
+    """Yield (occurrence, start, end, override) for each uncancelled occurrence of a
+    recurring event that overlaps the window, where occurrence is its original start.
+
+    Takes the event and its overrides as either ORM objects or rows with the same
+    attributes.
+    """
+    overridden = {override.occurrence for override in overrides}
+    for occurrence_start, occurrence_end in occurrences(
+        event.start, event.end, parse_rule(event.recurrence), start, end
+    ):
+        if occurrence_start not in overridden:
+            yield occurrence_start, occurrence_start, occurrence_end, None
+
+    # Overridden occurrences, including those moved into the window from outside it
+    for override in overrides:
+        if override.cancelled:
+            continue
+        override_start = (
+            override.start if override.start is not None else override.occurrence
+        )
+        override_end = (
+            override.end
+            if override.end is not None
+            else override_start + event.end - event.start
+        )
+        if override_start < end and (start is None or override_end > start):
+            yield override.occurrence, override_start, override_end, override
+
+
+async def find_conflicts(
+    session: AsyncSession,
+    user_ids: Collection[UUID],
+    times: Sequence[Tuple[int, int]],
+    exclude: UUID | None = None,
+) -> List[Tuple[UUID, int, int]]:
+    """(user_id, start, end) of the users' events and occurrences overlapping any of
+    the given times, which must be sorted by start.
+
+    Candidates come from a range query on ix_events_span over the times' overall
+    window, and each one is checked against the times with a binary search.
+    """
+    if not times:
+        return []
+    starts = [start for start, _ in times]
+    # Latest end among the times up to each position, so one lookup settles overlap
+    reach = list(accumulate((end for _, end in times), max))
+    window = (starts[0], reach[-1])
+
+    conditions = in_window(*window)
+    if exclude is not None:
+        conditions.append(Event.id != exclude)
+    rows = (await session.execute(calendar_entries(user_ids, *conditions))).all()
+
+    recurring = {row.id for row in rows if row.recurrence is not None}
+    series = {}
+    if recurring:
+        series = {
+            event.id: event
+            for event in await session.scalars(
+                select(Event)
+                .where(Event.id.in_(recurring))
+                .options(selectinload(Event.overrides))
+            )
+        }
+
+    conflicts = []
+    for row in rows:
+        if row.recurrence is None:
+            candidates = [(row.start, row.end)]
+        else:
+            candidates = [
+                (start, end)
+                for _, start, end, _ in occurrence_times(
+                    series[row.id], series[row.id].overrides, *window
+                )
+            ]
+        for start, end in candidates:
+            index = bisect_left(starts, end)
+            if index and reach[index - 1] > start:
+                conflicts.append((row.user_id, start, end))
+    return conflicts
+
+
+async def bump_calendar_versions(
+    session: AsyncSession,
+    event_ids: Sequence[UUID] | Select | CompoundSelect,
+    archived: bool = False,
+) -> None:
+    """Mark the given events as changed for every owner and attendee.
+
+    Each affected user's calendar_version is incremented, the events are appended to
+    their change log under the new version, and subscribers are notified on commit.
+    Call this inside the mutating transaction, before removing anyone's access to an
+    event and after granting it, so every user whose view changes is covered. Pass
+    archived for changes to a user, which show in their archived events as well.
+    """
+    viewed = [
+        select(Event.owner_id, Event.id).where(Event.id.in_(event_ids)),
+        select(
+            user_event_association.c.user_id, user_event_association.c.event_id
+        ).where(user_event_association.c.event_id.in_(event_ids)),
+    ]
+    if archived:
+        viewed += [
+            select(ArchivedEvent.owner_id, ArchivedEvent.id).where(
+                ArchivedEvent.id.in_(event_ids)
+            ),
+            select(archived_attendance.c.user_id, archived_attendance.c.event_id).where(
+                archived_attendance.c.event_id.in_(event_ids)
+            ),
+        ]
+    viewers = (await session.execute(union(*viewed))).all()
+    if not viewers:
+        return
+
+    user_ids = {user_id for user_id, _ in viewers}
+    # In id order, so that transactions bumping overlapping users take turns instead
+    # of deadlocking, as an UPDATE locks its rows in whatever order it finds them
+    await session.execute(
+        select(User.id)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update(key_share=True)
+    )
+    versions = dict(
+        (
+            await session.execute(
+                update(User)
+                .where(User.id.in_(user_ids))
+                .values(calendar_version=User.calendar_version + 1)
+                .returning(User.id, User.calendar_version)
+                .execution_options(synchronize_session=False)
+            )
+        ).all()
+    )
+    await session.execute(
+        insert(CalendarChange),
+        [
+            {"user_id": user_id, "version": versions[user_id], "event_id": event_id}
+            for user_id, event_id in viewers
+        ],
+    )
+    await broker.publish(session, versions)
+
+
+async def changed_event_ids(
+    session: AsyncSession, user_id: UUID, since: int
+) -> List[UUID] | None:
+    """Events changed for the user after version `since`, which must be older than the
+    user's current calendar_version. Returns None if the log no longer reaches back to
+    `since`, in which case the client has to resync in full."""
+    oldest, event_ids = (
+        await session.execute(
+            select(
+                func.min(CalendarChange.version),
+                func.array_agg(CalendarChange.event_id.distinct()),
+            ).where(CalendarChange.user_id == user_id, CalendarChange.version > since)
+        )
+    ).one()
+    if oldest != since + 1:
+        return None
+    return event_ids
+
+
+async def truncate_change_log() -> None:
+    """Periodically drop change log entries older than the retention window."""
+    while True:
+        cutoff = int(time.time()) - settings.change_log_retention
+        try:
+            session: AsyncSession
+            async with AsyncDBSession() as session:
+                await session.execute(
+                    delete(CalendarChange).where(CalendarChange.changed_at < cutoff)
+                )
+                await session.commit()
+        except Exception:
+            # Such as the database being briefly unreachable; the next run catches up
+            logger.exception("Truncating the change log failed")
+        await asyncio.sleep(60 * 60)
@@ -1,9 +1,25 @@
+import time
 import uuid
+from dataclasses import dataclass
 from typing import List
 
 from config.config import settings
-from sqlalchemy import Column, ForeignKey, String, Table, create_engine
+from sqlalchemy import (
+    Column,
+    Engine,
+    ForeignKey,
+    ForeignKeyConstraint,
+    Index,
+    Integer,
+    String,
+    Table,
+    create_engine,
+    func,
+    make_url,
+    select,
+)
 from sqlalchemy.dialects.postgresql import UUID as _UUIDC
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -23,7 +39,8 @@ user_event_association = Table(
     "user_event_association",
     Base.metadata,
     Column("user_id", ForeignKey("users.id", ondelete="cascade"), primary_key=True),
-    Column("event_id", ForeignKey("events.id", ondelete="cascade"), primary_key=True),
+    # The primary key covers lookups by user; event_id needs its own index
+    Column("event_id", ForeignKey("events.id", ondelete="cascade"), primary_key=True, index=True),
 )
 
 
@@ -31,9 +48,10 @@ class User(Base):
     __tablename__ = "users"
 
     id: Mapped[uuid.UUID] = mapped_column(UUIDC, primary_key=True, default=uuid.uuid4)
-    username: Mapped[str] = mapped_column(String(20), nullable=False)
-    email: Mapped[str] = mapped_column(String(254), nullable=False)
+    username: Mapped[str] = mapped_column(String(20), nullable=False, unique=True, index=True)
+    email: Mapped[str] = mapped_column(String(254), nullable=False, unique=True, index=True)
     password_hash: Mapped[str] = mapped_column(String, nullable=False)
+    calendar_version: Mapped[int] = mapped_column(nullable=False, default=0, server_default="0")
     owned_events: Mapped[List["Event"]] = relationship(back_populates="owner")
     attending_events: Mapped[List["Event"]] = relationship(
         secondary=user_event_association, back_populates="attendees"
@@ -49,14 +67,224 @@ class Event(Base):
     start: Mapped[int] = mapped_column(nullable=False)
     end: Mapped[int] = mapped_column(nullable=False)
     owner: Mapped[User] = relationship(back_populates="owned_events")
-    owner_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("users.id", ondelete="cascade"))
+    owner_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("users.id", ondelete="cascade"), index=True
+    )
     attendees: Mapped[List[User]] = relationship(
         secondary=user_event_association,
         back_populates="attending_events",
     )
+    # RRULE for repeating events; start/end then describe the first occurrence
+    recurrence: Mapped[str | None] = mapped_column(nullable=True)
+    # End of the last occurrence, NULL for series that repeat forever. Indexed for finding
+    # the events to archive.
+    series_end: Mapped[int | None] = mapped_column(nullable=True, index=True)
+    overrides: Mapped[List["OccurrenceOverride"]] = relationship(
+        cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    __table_args__ = (Index("ix_events_start_end", "start", "end"),)
+
+
+# Time covered by an event, or by every occurrence of a series: [start, series_end), unbounded
+# for series that repeat forever. Window and overlap queries match on this through the index.
+event_span = func.int4range(func.least(Event.start, Event.series_end), Event.series_end)
+Index("ix_events_span", event_span, postgresql_using="gist")
+
+
+class OccurrenceOverride(Base):
+    """A cancelled or individually edited occurrence of a recurring event."""
+
+    __tablename__ = "occurrence_overrides"
+
+    event_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("events.id", ondelete="cascade"), primary_key=True
+    )
+    # Original start of the occurrence being replaced
+    occurrence: Mapped[int] = mapped_column(primary_key=True)
+    cancelled: Mapped[bool] = mapped_column(nullable=False, default=False)
+    title: Mapped[str | None] = mapped_column(nullable=True)
+    description: Mapped[str | None] = mapped_column(nullable=True)
+    start: Mapped[int | None] = mapped_column(nullable=True)
+    end: Mapped[int | None] = mapped_column(nullable=True)
+
+
+class CalendarChange(Base):
+    """Append-only record of an event changing in a user's view of their calendar.
+
+    Rows are keyed by the user's calendar_version, so each user's log is gapless and
+    doubles as a sync cursor. No foreign key to events: deleted events must stay logged.
+    """
+
+    __tablename__ = "calendar_changes"
+
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("users.id", ondelete="cascade"), primary_key=True
+    )
+    version: Mapped[int] = mapped_column(primary_key=True)
+    event_id: Mapped[uuid.UUID] = mapped_column(UUIDC, primary_key=True)
+    changed_at: Mapped[int] = mapped_column(
+        nullable=False, default=lambda: int(time.time()), index=True
+    )
+
+
+class AgendaEntry(Base):
+    """An event as it appears in the calendar of its owner or one of its attendees.
+
+    A read model derived from the tables above, so that a user's calendar window is one
+    index range scan with nothing to join or render. refresh_agenda rewrites an event's
+    entries in the same transaction as every change to it, its attendees and overrides,
+    or the username of anyone on it; rebuild_agenda.py backfills and repairs the table.
+    """
+
+    __tablename__ = "agenda_entries"
+
+    event_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("events.id", ondelete="cascade"), primary_key=True
+    )
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("users.id", ondelete="cascade"), primary_key=True
+    )
+    start: Mapped[int] = mapped_column(nullable=False)
+    # The event's series_end: the end of its last occurrence, NULL if it repeats forever
+    end: Mapped[int | None] = mapped_column(nullable=True)
+    recurring: Mapped[bool] = mapped_column(nullable=False)
+    # The event as CleanEvent JSON, with recurring events unexpanded
+    payload: Mapped[str] = mapped_column(nullable=False)
+
+    __table_args__ = (Index("ix_agenda_entries_user_start", "user_id", "start", "event_id"),)
+
+
+# Events whose last occurrence ended longer than archive_after ago are moved from the tables
+# above to these, which database.archive partitions by month of series_end. A read of a window
+# only visits the partitions of months that ended after the window starts. Archived events are
+# read-only, and go only with their owner.
+archived_attendance = Table(
+    "user_event_association_archive",
+    Base.metadata,
+    Column("user_id", ForeignKey("users.id", ondelete="cascade"), primary_key=True),
+    Column("event_id", UUIDC, primary_key=True, index=True),
+    Column("series_end", Integer, primary_key=True),
+    ForeignKeyConstraint(
+        ["event_id", "series_end"],
+        ["events_archive.id", "events_archive.series_end"],
+        ondelete="cascade",
+    ),
+    postgresql_partition_by="RANGE (series_end)",
+)
+
+
+class ArchivedEvent(Base):
+    __tablename__ = "events_archive"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUIDC, primary_key=True)
+    title: Mapped[str] = mapped_column(nullable=False)
+    description: Mapped[str] = mapped_column(nullable=False)
+    start: Mapped[int] = mapped_column(nullable=False)
+    end: Mapped[int] = mapped_column(nullable=False)
+    owner: Mapped[User] = relationship(viewonly=True)
+    owner_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("users.id", ondelete="cascade"), index=True
+    )
+    attendees: Mapped[List[User]] = relationship(secondary=archived_attendance, viewonly=True)
+    recurrence: Mapped[str | None] = mapped_column(nullable=True)
+    # Also the partition key, so part of the primary key. Never NULL: series that repeat
+    # forever don't end, so they are never archived.
+    series_end: Mapped[int] = mapped_column(primary_key=True)
+    overrides: Mapped[List["ArchivedOccurrenceOverride"]] = relationship(viewonly=True)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (series_end)"}
+
+
+class ArchivedOccurrenceOverride(Base):
+    __tablename__ = "occurrence_overrides_archive"
+
+    event_id: Mapped[uuid.UUID] = mapped_column(UUIDC, primary_key=True)
+    series_end: Mapped[int] = mapped_column(primary_key=True)
+    occurrence: Mapped[int] = mapped_column(primary_key=True)
+    cancelled: Mapped[bool] = mapped_column(nullable=False)
+    title: Mapped[str | None] = mapped_column(nullable=True)
+    description: Mapped[str | None] = mapped_column(nullable=True)
+    start: Mapped[int | None] = mapped_column(nullable=True)
+    end: Mapped[int | None] = mapped_column(nullable=True)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["event_id", "series_end"],
+            ["events_archive.id", "events_archive.series_end"],
+            ondelete="cascade",
+        ),
+        {"postgresql_partition_by": "RANGE (series_end)"},
+    )
+
+
+@dataclass(frozen=True)
+class EventTables:
+    """An events table with the attendance and override tables that belong to it."""
+
+    events: type[Event] | type[ArchivedEvent]
+    attendance: Table
+    overrides: type[OccurrenceOverride] | type[ArchivedOccurrenceOverride]
+    # Whether the tables are partitioned by series_end, which queries then bound
+    partitioned: bool = False
+
+
+LIVE = EventTables(Event, user_event_association, OccurrenceOverride)
+ARCHIVE = EventTables(ArchivedEvent, archived_attendance, ArchivedOccurrenceOverride, True)
+
+
+# Created by create_engines when the app starts, so importing the models never touches the
+# database. Request handlers use the asyncpg engine; the sync one is for scripts.
+engine: Engine | None = None
+async_engine: AsyncEngine | None = None
+
+DBSession: sessionmaker = sessionmaker()
+AsyncDBSession: async_sessionmaker = async_sessionmaker(expire_on_commit=False)
+
+# Key of the advisory lock held while creating the schema
+SCHEMA_LOCK = 0x6461796472
+
+
+def create_engines() -> tuple[Engine, AsyncEngine]:
+    """Create both engines, if not done yet, and bind the session factories to them.
+
+    Each worker process has its own pools, so the database must accept up to
+    workers * (db_pool_size + db_max_overflow) connections.
+    """
+    global engine, async_engine
+    if async_engine is not None:
+        return engine, async_engine
+    pool = dict(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+    engine = create_engine(
+        settings.db_url,
+        connect_args={"connect_timeout": round(settings.db_connect_timeout)},
+        **pool,
+    )
+    async_engine = create_async_engine(
+        make_url(settings.db_url).set(drivername="postgresql+asyncpg"),
+        connect_args={"timeout": settings.db_connect_timeout},
+        **pool,
+    )
+    DBSession.configure(bind=engine)
+    AsyncDBSession.configure(bind=async_engine)
+    return engine, async_engine
+
 
+async def create_schema() -> None:
+    """Create missing tables and indexes, one worker at a time."""
+    async with async_engine.begin() as connection:
+        await connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK)))
+        await connection.run_sync(Base.metadata.create_all)
 
-engine = create_engine(settings.db_url)
-Base.metadata.create_all(engine)
 
-DBSession: sessionmaker = sessionmaker(engine)
+async def dispose_engines() -> None:
+    """Close pooled connections; the engines stay usable and reconnect on demand."""
+    if async_engine is not None:
+        await async_engine.dispose()
+        engine.dispose()
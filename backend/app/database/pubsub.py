@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Dict, List, Set
+from uuid import UUID
+
+import asyncpg
+from config.config import settings
+from database.database import AsyncDBSession, User
+from security.cache import load_taken_names, taken_names, user_cache
+from sqlalchemy import event, make_url, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+CHANNEL = "calendar_changes"
+_PENDING = "calendar_notifications"
+NAMES_CHANNEL = "taken_names"
+_PENDING_NAMES = "taken_name_notifications"
+USERS_CHANNEL = "user_changes"
+_PENDING_USERS = "user_change_notifications"
+# Seconds before the first attempt to listen again after losing the connection,
+# doubled after every failed attempt up to the maximum
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker:
+    """Fans calendar version changes out to subscribers in this process.
+
+    Subscribers get the user's latest calendar_version and are expected to catch up
+    through /event/changes, so a slow subscriber only ever needs the newest value.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[UUID, Set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, user_id: UUID) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: UUID, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def deliver(self, user_id: UUID, version: int) -> None:
+        for queue in self._subscribers.get(user_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(version)
+
+    async def publish(self, session: AsyncSession, versions: Dict[UUID, int]) -> None:
+        """Queue notifications to go out once the session's transaction commits."""
+        session.info.setdefault(_PENDING, {}).update(versions)
+
+    async def publish_names(self, session: AsyncSession, names: List[str]) -> None:
+        """Queue names to be added to every worker's taken_names once committed."""
+        session.info.setdefault(_PENDING_NAMES, []).extend(names)
+
+    async def publish_user_changes(
+        self, session: AsyncSession, user_ids: List[UUID]
+    ) -> None:
+        """Queue users to be dropped from every worker's user_cache once committed."""
+        session.info.setdefault(_PENDING_USERS, []).extend(user_ids)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class PostgresBroker(LocalBroker):
+    """Relays notifications between worker processes through LISTEN/NOTIFY.
+
+    NOTIFY is issued inside the mutating transaction, so Postgres only delivers it
+    on commit, and every worker (this one included) receives it on its listener.
+    Should the listener's connection drop, it reconnects with backoff and then
+    rebuilds what the notifications sent meanwhile would have kept up to date.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._connection: asyncpg.Connection | None = None
+        self._reconnecting: asyncio.Task | None = None
+
+    async def publish(self, session: AsyncSession, versions: Dict[UUID, int]) -> None:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            [
+                {"channel": CHANNEL, "payload": json.dumps([str(user_id), version])}
+                for user_id, version in versions.items()
+            ],
+        )
+
+    async def publish_names(self, session: AsyncSession, names: List[str]) -> None:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": NAMES_CHANNEL, "payload": json.dumps(names)},
+        )
+
+    async def publish_user_changes(
+        self, session: AsyncSession, user_ids: List[UUID]
+    ) -> None:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {
+                "channel": USERS_CHANNEL,
+                "payload": json.dumps([str(user_id) for user_id in user_ids]),
+            },
+        )
+
+    def _on_notify(self, connection, pid, channel, payload: str) -> None:
+        user_id, version = json.loads(payload)
+        self.deliver(UUID(user_id), version)
+
+    def _on_names(self, connection, pid, channel, payload: str) -> None:
+        taken_names.update(json.loads(payload))
+
+    def _on_user_changes(self, connection, pid, channel, payload: str) -> None:
+        for user_id in json.loads(payload):
+            user_cache.invalidate(UUID(user_id))
+
+    def _on_termination(self, connection: asyncpg.Connection) -> None:
+        # stop() forgets the connection before closing it
+        if connection is not self._connection:
+            return
+        logger.warning("Lost the connection listening for notifications")
+        self._connection = None
+        if self._reconnecting is None or self._reconnecting.done():
+            self._reconnecting = asyncio.create_task(self._reconnect())
+
+    async def _listen(self) -> None:
+        url = make_url(settings.db_url).set(drivername="postgresql")
+        connection = await asyncpg.connect(url.render_as_string(hide_password=False))
+        await connection.add_listener(CHANNEL, self._on_notify)
+        await connection.add_listener(NAMES_CHANNEL, self._on_names)
+        await connection.add_listener(USERS_CHANNEL, self._on_user_changes)
+        connection.add_termination_listener(self._on_termination)
+        self._connection = connection
+
+    async def _catch_up(self) -> None:
+        """Rebuild what notifications keep current, as any sent while no connection
+        was listening are lost: cached users may have changed, taken_names may lack
+        new names, and subscribers may have missed a version."""
+        user_cache.clear()
+        await load_taken_names()
+        subscribed = list(self._subscribers)
+        if subscribed:
+            session: AsyncSession
+            async with AsyncDBSession() as session:
+                versions = await session.execute(
+                    select(User.id, User.calendar_version).where(
+                        User.id.in_(subscribed)
+                    )
+                )
+            for user_id, version in versions:
+                self.deliver(user_id, version)
+
+    async def _reconnect(self) -> None:
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                if self._connection is None:
+                    await self._listen()
+                await self._catch_up()
+            except Exception as error:
+                delay = min(2 * delay, MAX_RECONNECT_DELAY)
+                logger.warning(
+                    "Listening for notifications again failed, retrying in %.1fs: %s",
+                    delay,
+                    error,
+                )
+                continue
+            # Unless the connection dropped again while catching up
+            if self._connection is not None:
+                logger.info("Listening for notifications again")
+                return
+
+    async def start(self) -> None:
+        await self._listen()
+
+    async def stop(self) -> None:
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            await connection.close()
+
+
+broker: LocalBroker = (
+    PostgresBroker() if settings.pubsub_backend == "postgres" else LocalBroker()
+)
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_pending(session: Session) -> None:
+    for user_id, version in session.info.pop(_PENDING, {}).items():
+        broker.deliver(user_id, version)
+    taken_names.update(session.info.pop(_PENDING_NAMES, []))
+    for user_id in session.info.pop(_PENDING_USERS, []):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session: Session) -> None:
+    session.info.pop(_PENDING, None)
+    session.info.pop(_PENDING_NAMES, None)
+    session.info.pop(_PENDING_USERS, None)
@@ -0,0 +1,281 @@
+"""iCalendar (RFC 5545) reading and writing of events.
+
+Only what the calendar stores is handled: times are UTC, attendees are identified by
+username, and recurring events carry their RRULE with overridden occurrences as
+separate components sharing the series' UID. Zoned times are read as if they were UTC.
+"""
+
+import codecs
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+from uuid import UUID
+
+from recurrence import DAY, parse_rule
+
+CALENDAR_HEADER = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "PRODID:-//Day Dreamers//Calendar//EN\r\n"
+    "CALSCALE:GREGORIAN\r\n"
+)
+CALENDAR_FOOTER = "END:VCALENDAR\r\n"
+
+# Content lines are folded at 75 octets, continuation lines start with a space
+LINE_LIMIT = 75
+
+
+def format_time(timestamp: int) -> str:
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(timestamp))
+
+
+def parse_time(value: str) -> int:
+    value = value.removesuffix("Z")
+    layout = "%Y%m%dT%H%M%S" if "T" in value else "%Y%m%d"
+    return int(
+        datetime.strptime(value, layout).replace(tzinfo=timezone.utc).timestamp()
+    )
+
+
+DURATION = re.compile(
+    r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?"
+)
+
+
+def parse_duration(value: str) -> int:
+    match = DURATION.fullmatch(value)
+    if not match or value.endswith(("P", "T")):
+        raise ValueError(f"Malformed duration {value!r}")
+    sign, *amounts = match.groups()
+    weeks, days, hours, minutes, seconds = (int(amount or 0) for amount in amounts)
+    total = (weeks * 7 + days) * DAY + hours * 3600 + minutes * 60 + seconds
+    return -total if sign == "-" else total
+
+
+def escape_text(text: str) -> str:
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def unescape_text(text: str) -> str:
+    return re.sub(r"\\(.)", lambda match: "\n" if match[1] in "nN" else match[1], text)
+
+
+def content_line(name: str, value: str) -> str:
+    line = f"{name}:{value}"
+    encoded = line.encode()
+    if len(encoded) <= LINE_LIMIT:
+        return line + "\r\n"
+
+    parts = []
+    limit = LINE_LIMIT
+    while encoded:
+        cut = min(limit, len(encoded))
+        # Never split a multi-byte character across lines
+        while cut < len(encoded) and encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+        limit = LINE_LIMIT - 1
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def escape_parameter(value: str) -> str:
+    # Parameter values can't be escaped, only quoted, and can't contain quotes
+    value = value.replace('"', "'")
+    return f'"{value}"' if any(char in value for char in ",:;") else value
+
+
+def address_line(name: str, user: Tuple[UUID, str]) -> str:
+    user_id, username = user
+    return content_line(
+        f"{name};CN={escape_parameter(username)}", f"urn:uuid:{user_id}"
+    )
+
+
+def vevent(
+    uid: str,
+    stamp: int,
+    start: int,
+    end: int,
+    title: str,
+    description: str,
+    organizer: Tuple[UUID, str],
+    attendees: Iterable[Tuple[UUID, str]] = (),
+    recurrence: str | None = None,
+    exdates: Iterable[int] = (),
+    recurrence_id: int | None = None,
+) -> str:
+    """One VEVENT component, with the organizer and attendees as (id, username)."""
+    lines = [
+        "BEGIN:VEVENT\r\n",
+        content_line("UID", uid),
+        content_line("DTSTAMP", format_time(stamp)),
+    ]
+    if recurrence_id is not None:
+        lines.append(content_line("RECURRENCE-ID", format_time(recurrence_id)))
+    lines += [
+        content_line("DTSTART", format_time(start)),
+        content_line("DTEND", format_time(end)),
+        content_line("SUMMARY", escape_text(title)),
+    ]
+    if description:
+        lines.append(content_line("DESCRIPTION", escape_text(description)))
+    if recurrence is not None:
+        lines.append(content_line("RRULE", recurrence))
+    for exdate in exdates:
+        lines.append(content_line("EXDATE", format_time(exdate)))
+    lines.append(address_line("ORGANIZER", organizer))
+    lines += [address_line("ATTENDEE", attendee) for attendee in attendees]
+    lines.append("END:VEVENT\r\n")
+    return "".join(lines)
+
+
+Property = Tuple[str, Dict[str, str], str]
+
+# name;param=value;param="quoted:value":value
+PROPERTY = re.compile(r'([^;:]+)((?:;[^=;:]+=(?:"[^"]*"|[^;:]*))*):(.*)')
+PARAMETER = re.compile(r';([^=;:]+)=("[^"]*"|[^;:]*)')
+
+
+def split_property(line: str) -> Property | None:
+    match = PROPERTY.fullmatch(line)
+    if not match:
+        return None
+    name, parameters, value = match.groups()
+    return (
+        name.upper(),
+        {
+            key.upper(): parameter.strip('"')
+            for key, parameter in PARAMETER.findall(parameters)
+        },
+        value,
+    )
+
+
+class ComponentReader:
+    """Incrementally split an iCalendar stream into the properties of its VEVENTs.
+
+    Feed it the raw bytes in chunks of any size; each call returns the VEVENTs that
+    were completed by that chunk, so only the current event is ever held in memory.
+    Components nested inside an event, such as alarms, are skipped.
+    """
+
+    def __init__(self) -> None:
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._partial = ""
+        self._line: str | None = None
+        self._event: List[Property] | None = None
+        self._nesting = 0
+
+    def feed(self, data: bytes) -> List[List[Property]]:
+        *lines, self._partial = (self._partial + self._decoder.decode(data)).split("\n")
+        return self._read(lines)
+
+    def close(self) -> List[List[Property]]:
+        events = self._read([self._partial + self._decoder.decode(b"", final=True)])
+        if self._line is not None:
+            self._add(self._line, events)
+        self._partial, self._line = "", None
+        return events
+
+    def _read(self, lines: List[str]) -> List[List[Property]]:
+        events = []
+        for line in lines:
+            line = line.removesuffix("\r")
+            if line[:1] in (" ", "\t"):
+                # Folded continuation of the previous line
+                if self._line is not None:
+                    self._line += line[1:]
+                continue
+            if self._line is not None:
+                self._add(self._line, events)
+            self._line = line
+        return events
+
+    def _add(self, line: str, events: List[List[Property]]) -> None:
+        prop = split_property(line)
+        if prop is None:
+            return
+        name, _, value = prop
+        if name == "BEGIN":
+            if self._event is not None:
+                self._nesting += 1
+            elif value.upper() == "VEVENT":
+                self._event = []
+        elif name == "END" and self._event is not None:
+            if self._nesting:
+                self._nesting -= 1
+            else:
+                events.append(self._event)
+                self._event = None
+        elif self._event is not None and not self._nesting:
+            self._event.append(prop)
+
+
+@dataclass
+class VEvent:
+    uid: str | None
+    start: int
+    end: int
+    title: str
+    description: str
+    recurrence: str | None = None
+    # Set on components that replace one occurrence of a recurring event
+    recurrence_id: int | None = None
+    cancelled: bool = False
+    exdates: List[int] = field(default_factory=list)
+    attendees: List[str] = field(default_factory=list)
+
+
+def read_vevent(properties: List[Property]) -> VEvent:
+    """Validate a VEVENT's properties, raising ValueError if it can't be stored."""
+    first: Dict[str, Tuple[Dict[str, str], str]] = {}
+    exdates, attendees = [], []
+    for name, parameters, value in properties:
+        if name == "EXDATE":
+            exdates += [parse_time(exdate) for exdate in value.split(",")]
+        elif name == "ATTENDEE":
+            if "CN" in parameters:
+                attendees.append(parameters["CN"])
+        else:
+            first.setdefault(name, (parameters, value))
+
+    if "DTSTART" not in first:
+        raise ValueError("VEVENT has no DTSTART")
+    start_parameters, start_value = first["DTSTART"]
+    start = parse_time(start_value)
+    if "DTEND" in first:
+        end = parse_time(first["DTEND"][1])
+    elif "DURATION" in first:
+        end = start + parse_duration(first["DURATION"][1])
+    elif start_parameters.get("VALUE") == "DATE" or "T" not in start_value:
+        end = start + DAY
+    else:
+        end = start
+    if end < start:
+        raise ValueError("VEVENT ends before it starts")
+
+    recurrence = first.get("RRULE", (None, None))[1]
+    if recurrence is not None:
+        parse_rule(recurrence)
+    recurrence_id = first.get("RECURRENCE-ID", (None, None))[1]
+    return VEvent(
+        uid=first.get("UID", (None, None))[1],
+        start=start,
+        end=end,
+        title=unescape_text(first.get("SUMMARY", (None, ""))[1]),
+        description=unescape_text(first.get("DESCRIPTION", (None, ""))[1]),
+        recurrence=recurrence,
+        recurrence_id=None if recurrence_id is None else parse_time(recurrence_id),
+        cancelled=first.get("STATUS", (None, ""))[1].upper() == "CANCELLED",
+        exdates=exdates,
+        attendees=attendees,
+    )
@@ -0,0 +1,64 @@
+"""Vectorised operations on half-open [start, end) time intervals.
+
+Intervals are passed around as parallel int64 arrays of starts and ends so that the
+sweeps below run in NumPy rather than per interval in Python.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+Intervals = Tuple[np.ndarray, np.ndarray]
+
+
+def merge(starts: np.ndarray, ends: np.ndarray) -> Intervals:
+    """Merge overlapping and touching intervals, returning them sorted by start."""
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    # An interval opens a new block unless it starts before everything seen so far ends
+    reach = np.maximum.accumulate(ends)
+    opens = np.empty(len(starts), dtype=bool)
+    opens[0] = True
+    opens[1:] = starts[1:] > reach[:-1]
+    block_starts = np.flatnonzero(opens)
+    block_ends = np.append(block_starts[1:], len(starts)) - 1
+    return starts[block_starts], reach[block_ends]
+
+
+def merge_groups(
+    groups: np.ndarray, starts: np.ndarray, ends: np.ndarray, window: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge intervals separately within each group in a single sweep.
+
+    Intervals are clipped to the window and each group is shifted into its own
+    disjoint copy of it, so one merge never joins intervals from different groups.
+    Returns the group, start and end of every merged interval, ordered by group.
+    """
+    window_start, window_end = window
+    span = window_end - window_start
+    starts = np.clip(starts, window_start, window_end) - window_start
+    ends = np.clip(ends, window_start, window_end) - window_start
+    keep = ends > starts
+    groups, starts, ends = groups[keep], starts[keep], ends[keep]
+
+    offsets = groups.astype(np.int64) * (span + 1)
+    merged_starts, merged_ends = merge(starts + offsets, ends + offsets)
+    merged_groups = merged_starts // (span + 1)
+    offsets = merged_groups * (span + 1) - window_start
+    return merged_groups, merged_starts - offsets, merged_ends - offsets
+
+
+def gaps(
+    starts: np.ndarray, ends: np.ndarray, window: Tuple[int, int], min_length: int = 1
+) -> Intervals:
+    """The parts of the window not covered by any interval, at least min_length long.
+
+    Expects merged intervals, as returned by merge, lying within the window.
+    """
+    window_start, window_end = window
+    gap_starts = np.concatenate(([window_start], ends))
+    gap_ends = np.concatenate((starts, [window_end]))
+    keep = gap_ends - gap_starts >= max(min_length, 1)
+    return gap_starts[keep], gap_ends[keep]
@@ -1,13 +1,34 @@
+import argparse
+import os
+
 import uvicorn
 
 from config.config import settings
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API server.")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        help="run several worker processes instead of one that reloads on changes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.workers or os.cpu_count(),
+        help="worker processes in production mode (default: settings.workers or one per CPU)",
+    )
+    args = parser.parse_args()
+    if args.production and args.workers > 1 and settings.pubsub_backend != "postgres":
+        # Calendar streams and the taken names filter would only see their own worker
+        parser.error("several workers need pubsub_backend=postgres")
+
     uvicorn.run(
         "api.api:app",
         host=("::" if settings.is_ipv6 else "0.0.0.0"),
         port=8080,
-        reload=True,
         root_path="/api",
         proxy_headers=True,
+        forwarded_allow_ips=settings.forwarded_allow_ips,
+        **({"workers": args.workers} if args.production else {"reload": True}),
     )
@@ -0,0 +1,258 @@
+"""Request latency, database time and user cache use, in the Prometheus text format.
+
+MetricsMiddleware times every HTTP request by route, and the hooks installed by
+instrument_engine attribute each query to the request that ran it. Metrics are kept
+per worker process, so with several workers each one is scraped separately.
+"""
+
+import bisect
+import logging
+import math
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+
+from config.config import settings
+from security.cache import user_cache
+from sqlalchemy import Engine, event
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+MAX_STATEMENT_LENGTH = 1000
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels)
+        + "}"
+    )
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name: str, labels: Labels) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else str(bound)
+            yield f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {self.sum}"
+        yield f"{name}_count{format_labels(labels)} {cumulative}"
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_time: float = 0.0
+    # (seconds, SQL) of the first MAX_LOGGED_STATEMENTS queries
+    statements: List[Tuple[float, str]] = field(default_factory=list)
+
+
+# Set for the duration of each request; queries outside requests only count globally
+current_request: ContextVar[RequestStats | None] = ContextVar(
+    "current_request", default=None
+)
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.in_progress = 0
+        self.requests: Dict[Labels, Histogram] = {}
+        self.request_queries: Dict[Labels, int] = {}
+        self.request_db_time: Dict[Labels, float] = {}
+        self.rejections: Dict[Labels, int] = {}
+        self.queries = Histogram(QUERY_BUCKETS)
+
+    def record_request(
+        self, method: str, route: str, status: int, elapsed: float, stats: RequestStats
+    ) -> None:
+        labels = (("method", method), ("route", route))
+        with_status = labels + (("status", str(status)),)
+        if with_status not in self.requests:
+            self.requests[with_status] = Histogram(LATENCY_BUCKETS)
+        self.requests[with_status].observe(elapsed)
+        self.request_queries[labels] = (
+            self.request_queries.get(labels, 0) + stats.queries
+        )
+        self.request_db_time[labels] = (
+            self.request_db_time.get(labels, 0.0) + stats.db_time
+        )
+
+    def record_rejection(self, route_class: str, reason: str) -> None:
+        labels = (("class", route_class), ("reason", reason))
+        self.rejections[labels] = self.rejections.get(labels, 0) + 1
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_in_progress Requests currently being handled.",
+            "# TYPE http_requests_in_progress gauge",
+            f"http_requests_in_progress {self.in_progress}",
+            "# HELP http_request_duration_seconds Time until the response is sent.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for labels, histogram in sorted(self.requests.items()):
+            lines += histogram.lines("http_request_duration_seconds", labels)
+        lines += [
+            "# HELP http_request_db_queries_total Queries run while handling requests.",
+            "# TYPE http_request_db_queries_total counter",
+        ]
+        for labels, count in sorted(self.request_queries.items()):
+            lines.append(
+                f"http_request_db_queries_total{format_labels(labels)} {count}"
+            )
+        lines += [
+            "# HELP http_request_db_seconds_total Time spent in queries of requests.",
+            "# TYPE http_request_db_seconds_total counter",
+        ]
+        for labels, seconds in sorted(self.request_db_time.items()):
+            lines.append(
+                f"http_request_db_seconds_total{format_labels(labels)} {seconds}"
+            )
+        lines += [
+            "# HELP http_requests_rejected_total Requests turned away by admission.",
+            "# TYPE http_requests_rejected_total counter",
+        ]
+        for labels, count in sorted(self.rejections.items()):
+            lines.append(f"http_requests_rejected_total{format_labels(labels)} {count}")
+        cache = user_cache.stats()
+        lines += [
+            "# HELP user_cache_lookups_total Authenticated user lookups by outcome.",
+            "# TYPE user_cache_lookups_total counter",
+            f'user_cache_lookups_total{{result="hit"}} {cache["hits"]}',
+            f'user_cache_lookups_total{{result="miss"}} {cache["misses"]}',
+            "# HELP user_cache_entries Users currently cached.",
+            "# TYPE user_cache_entries gauge",
+            f"user_cache_entries {cache['size']}",
+            "# HELP db_query_duration_seconds Time to execute each query.",
+            "# TYPE db_query_duration_seconds histogram",
+            *self.queries.lines("db_query_duration_seconds", ()),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _start_query(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _end_query(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info["query_start"].pop()
+    metrics.queries.observe(elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+        if len(stats.statements) < MAX_LOGGED_STATEMENTS:
+            stats.statements.append((elapsed, statement))
+
+
+def _fail_query(context):
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Time every query run through the engine; pass async engines' sync_engine.
+
+    Safe to call again for the same engine, e.g. on every app startup.
+    """
+    for name, listener in (
+        ("before_cursor_execute", _start_query),
+        ("after_cursor_execute", _end_query),
+        ("handle_error", _fail_query),
+    ):
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+class MetricsMiddleware:
+    """Record each HTTP request's latency and queries, logging the slow ones.
+
+    Requests are labelled with the route's path template so that ids in URLs don't
+    create a series each; requests that match no route share one label.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        # Event streams stay open by design, so their duration says nothing about speed
+        streaming = False
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = any(
+                    name == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", ())
+                )
+            await send(message)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        metrics.in_progress += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.in_progress -= 1
+            current_request.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            metrics.record_request(scope["method"], route_path, status, elapsed, stats)
+            if elapsed >= settings.slow_request_threshold and not streaming:
+                log_slow_request(scope, status, elapsed, stats)
+
+
+def log_slow_request(
+    scope: Scope, status: int, elapsed: float, stats: RequestStats
+) -> None:
+    statements = "".join(
+        f"\n  {seconds * 1000:8.1f} ms  {' '.join(statement.split())[:MAX_STATEMENT_LENGTH]}"
+        for seconds, statement in stats.statements
+    )
+    logger.warning(
+        "Slow request %s %s -> %d took %.3fs, %d queries in %.3fs%s",
+        scope["method"],
+        scope["path"],
+        status,
+        elapsed,
+        stats.queries,
+        stats.db_time,
+        statements,
+    )
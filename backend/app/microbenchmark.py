@@ -0,0 +1,233 @@
+"""Time the CPU-bound parts of serving calendars, per 1,000 events, without a database.
+
+Builds --events rows shaped like those load_event_rows returns, every --series-every
+one a recurring series with an edited occurrence, and times each of these over them,
+keeping the best of --repeat runs:
+
+- serializing them through CleanEvent models as FastAPI's response_model does, as
+  payload dicts, and as full, compact and columnar PayloadResponse bodies, and
+  joining stored agenda payloads as the agenda read path does;
+- expanding them over a month from rows and from stored payloads;
+- computing series_end for daily, weekly and monthly series of --series-length
+  occurrences, against walking each series to its last occurrence, which
+  series_end only still does for monthly ones.
+
+Results are saved as JSON; pass an earlier result as --compare to see what changed,
+and the exit status is 1 if any scenario got slower by more than --tolerance:
+
+    python microbenchmark.py --output before.json
+"""
+
+import argparse
+import gc
+import json
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import orjson
+from api.payloads import (
+    EventRows,
+    PayloadResponse,
+    columnar_payload,
+    compact_payload,
+    event_payloads,
+    expand_payloads,
+    occurrence_payloads,
+)
+from api.routers.event import CleanEvent
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from recurrence import DAY, occurrences, parse_rule, series_end
+
+# Event times are stored as int4
+BASE_TIME = 1_700_000_000
+SEED_SPAN = 90 * DAY
+WINDOW = 30 * DAY
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+
+
+def build_rows(events: int, fan_out: int, series_every: int, rng: random.Random) -> EventRows:
+    users = [(uuid.uuid4(), f"user{index}") for index in range(max(50, fan_out + 1))]
+    rows, attendees, overrides = [], {}, {}
+    for index in range(events):
+        owner_id, owner_username = rng.choice(users)
+        start = BASE_TIME + rng.randrange(SEED_SPAN)
+        end = start + rng.choice((1800, 3600, 7200))
+        recurrence = "FREQ=DAILY;COUNT=30" if index % series_every == 0 else None
+        row = SimpleNamespace(
+            id=uuid.uuid4(),
+            title=f"Event {index}",
+            description="Created by microbenchmark.py",
+            start=start,
+            end=end,
+            owner_id=owner_id,
+            owner_username=owner_username,
+            recurrence=recurrence,
+            series_end=series_end(start, end, recurrence),
+        )
+        rows.append(row)
+        attendees[row.id] = [
+            {"id": user_id, "username": username}
+            for user_id, username in rng.sample(users, fan_out)
+        ]
+        if recurrence is not None:
+            overrides[row.id] = [
+                SimpleNamespace(
+                    event_id=row.id,
+                    occurrence=start + DAY,
+                    cancelled=False,
+                    title="Moved",
+                    description=None,
+                    start=start + DAY + 3600,
+                    end=end + DAY + 3600,
+                )
+            ]
+    rows.sort(key=lambda row: (row.start, str(row.id)))
+    return EventRows(rows, attendees, overrides)
+
+
+def scenarios(rows: EventRows, series_length: int) -> Dict[str, Callable[[], object]]:
+    models = TypeAdapter(List[CleanEvent])
+    stored = [orjson.dumps(payload, default=str).decode() for payload in event_payloads(rows)]
+    window_start = BASE_TIME + SEED_SPAN // 2
+    series = {
+        freq: [(row.start, row.end, f"FREQ={freq};COUNT={series_length}") for row in rows.events]
+        for freq in FREQUENCIES
+    }
+
+    def walk(start: int, end: int, recurrence: str) -> int:
+        last_end = end
+        for _, last_end in occurrences(start, end, parse_rule(recurrence)):
+            pass
+        return last_end
+
+    return {
+        "serialize models": lambda: JSONResponse(
+            jsonable_encoder(models.validate_python(event_payloads(rows)))
+        ).body,
+        "serialize payloads": lambda: event_payloads(rows),
+        "serialize full": lambda: PayloadResponse(event_payloads(rows)).body,
+        "serialize compact": lambda: PayloadResponse(compact_payload(event_payloads(rows))).body,
+        "serialize columnar": lambda: PayloadResponse(columnar_payload(event_payloads(rows))).body,
+        "serialize agenda": lambda: "[" + ",".join(stored) + "]",
+        "expand rows": lambda: occurrence_payloads(rows, window_start, window_start + WINDOW),
+        "expand stored": lambda: expand_payloads(
+            [orjson.loads(payload) for payload in stored], window_start, window_start + WINDOW
+        ),
+        **{
+            f"series_end {freq.lower()}": lambda freq=freq: [
+                series_end(*arguments) for arguments in series[freq]
+            ]
+            for freq in FREQUENCIES
+        },
+        **{
+            f"walk {freq.lower()}": lambda freq=freq: [
+                walk(*arguments) for arguments in series[freq]
+            ]
+            for freq in FREQUENCIES
+        },
+    }
+
+
+def measure(scenario: Callable[[], object], repeat: int, events: int) -> float:
+    """Milliseconds per 1,000 events of the fastest of repeat runs."""
+    best = float("inf")
+    # As timeit does, so that collections triggered by earlier runs don't add noise
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            scenario()
+            best = min(best, time.perf_counter() - started)
+    finally:
+        gc.enable()
+    return round(best * 1000 * 1000 / events, 3)
+
+
+def compare(previous: dict, current: dict, tolerance: float) -> bool:
+    """Print the change per scenario; True if any got slower by tolerance."""
+    regressed = False
+    print(f"\nCompared with {previous.get('commit')} from {previous.get('started_at')}:")
+    for name, milliseconds in current["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if not before:
+            continue
+        change = (milliseconds - before) / before
+        line = f"{name:22} {before} -> {milliseconds} ({change:+.0%})"
+        if change > tolerance:
+            regressed = True
+            line += " REGRESSION"
+        print(line)
+    return regressed
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Time serialization and series expansion.")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--fan-out", type=int, default=3, help="attendees of each event")
+    parser.add_argument(
+        "--series-every", type=int, default=10, help="make every nth event a series"
+    )
+    parser.add_argument(
+        "--series-length", type=int, default=365, help="occurrences of series_end's series"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each, the best is kept")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the rows")
+    parser.add_argument("--output", default="microbenchmark.json", help="where to save results")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="relative slowdown counted as a regression"
+    )
+    args = parser.parse_args()
+
+    rows = build_rows(args.events, args.fan_out, args.series_every, random.Random(args.seed))
+    timings = {
+        name: measure(scenario, args.repeat, args.events)
+        for name, scenario in scenarios(rows, args.series_length).items()
+    }
+    print(f"{'scenario':22} {'ms per 1k events':>17}")
+    for name, milliseconds in timings.items():
+        print(f"{name:22} {milliseconds:17}")
+
+    results = {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            name: getattr(args, name)
+            for name in ("events", "fan_out", "series_every", "series_length", "repeat", "seed")
+        },
+        "scenarios": timings,
+    }
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as earlier:
+            previous = json.load(earlier)
+        if previous.get("config") != results["config"]:
+            print("Warning: the compared run used a different configuration")
+        if compare(previous, results, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
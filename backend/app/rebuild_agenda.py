@@ -0,0 +1,108 @@
+"""Rebuild agenda_entries from the events, attendees, overrides and users behind them.
+
+Backfills the table after it is added to an existing database, and repairs it should it
+ever drift from its sources. Events are processed in batches of --batch-size, each in a
+transaction of its own that locks its events the way refresh_agenda does, so the API
+can keep serving and writing meanwhile. Until the first backfill has finished, run the
+API with agenda_reads=false.
+
+    python rebuild_agenda.py            # rewrite every entry
+    python rebuild_agenda.py --check    # only count entries that differ, exit 1 if any
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from typing import Dict, Tuple
+from uuid import UUID
+
+import orjson
+from api.agenda import AGENDA_BATCH_SIZE, refresh_agenda, render_entries
+from database.database import AgendaEntry, AsyncDBSession, Base, Event, create_engines
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def comparable(entry: dict) -> tuple:
+    """An entry with its payload parsed and its lists in a fixed order, since the
+    queries that render them don't order attendees or overrides. A payload that isn't a
+    valid event stays text, so it differs from every rendered one."""
+    payload = entry["payload"]
+    try:
+        event = orjson.loads(payload)
+        event["attendees"].sort(key=lambda attendee: attendee["id"])
+        event["overrides"].sort(key=lambda override: override["occurrence"])
+        payload = orjson.dumps(event)
+    except (orjson.JSONDecodeError, TypeError, KeyError):
+        pass
+    return (entry["start"], entry["end"], entry["recurring"], payload)
+
+
+async def count_drift(session: AsyncSession, event_ids: list) -> int:
+    """How many of the events' entries are missing, extra or out of date."""
+    expected: Dict[Tuple[UUID, UUID], tuple] = {
+        (entry["event_id"], entry["user_id"]): comparable(entry)
+        for entry in await render_entries(session, event_ids)
+    }
+    stored = {
+        (entry.event_id, entry.user_id): comparable(entry._asdict())
+        for entry in await session.execute(
+            select(
+                AgendaEntry.event_id,
+                AgendaEntry.user_id,
+                AgendaEntry.start,
+                AgendaEntry.end,
+                AgendaEntry.recurring,
+                AgendaEntry.payload,
+            ).where(AgendaEntry.event_id.in_(event_ids))
+        )
+    }
+    return sum(expected.get(key) != stored.get(key) for key in expected.keys() | stored)
+
+
+async def rebuild(batch_size: int, check: bool) -> Tuple[int, int]:
+    """Go through every event in id order, returning how many there were and how many
+    entries differed from what the tables say they should be."""
+    events = drifted = 0
+    last_id = None
+    while True:
+        session: AsyncSession
+        async with AsyncDBSession() as session:
+            query = select(Event.id).order_by(Event.id).limit(batch_size)
+            if last_id is not None:
+                query = query.where(Event.id > last_id)
+            event_ids = (await session.scalars(query)).all()
+            if not event_ids:
+                return events, drifted
+            drift = await count_drift(session, event_ids)
+            if drift and not check:
+                await refresh_agenda(session, event_ids)
+                await session.commit()
+        events += len(event_ids)
+        drifted += drift
+        last_id = event_ids[-1]
+        print(f"{events} events, {drifted} entries {'differ' if check else 'rewritten'}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--check", action="store_true", help="report drift without writing anything"
+    )
+    parser.add_argument("--batch-size", type=int, default=AGENDA_BATCH_SIZE)
+    args = parser.parse_args()
+
+    engine, _ = create_engines()
+    Base.metadata.create_all(engine)
+    started = time.perf_counter()
+    events, drifted = asyncio.run(rebuild(args.batch_size, args.check))
+    print(
+        f"Done in {time.perf_counter() - started:.1f}s: {events} events, {drifted} entries "
+        f"{'differ' if args.check else 'rewritten'}"
+    )
+    return 1 if args.check and drifted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""Recurrence rules for repeating events.
+
+Supports the subset of RFC 5545 RRULEs the calendar needs: FREQ=DAILY, WEEKLY or
+MONTHLY with INTERVAL, COUNT, UNTIL and, for weekly rules, BYDAY. Weeks start on
+Monday. Times are unix seconds and all arithmetic is done in UTC, like the rest of
+the API.
+"""
+
+import calendar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Iterator, Tuple
+
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+# Occurrences a COUNT rule may have, which keeps walking a series cheap
+MAX_COUNT = 10_000
+# Longer would put a monthly series' second occurrence centuries out
+MAX_INTERVAL = 1000
+# Times are stored as 32-bit integers
+TIME_RANGE = range(-(2**31), 2**31)
+
+
+@dataclass(frozen=True)
+class Rule:
+    freq: str
+    interval: int = 1
+    count: int | None = None
+    until: int | None = None
+    byday: Tuple[int, ...] = ()
+
+    @property
+    def bounded(self) -> bool:
+        return self.count is not None or self.until is not None
+
+
+def _parse_until(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+@lru_cache(maxsize=4096)
+def parse_rule(text: str) -> Rule:
+    """Parse an RRULE string, raising ValueError for anything outside the subset."""
+    parts = {}
+    for part in text.upper().removeprefix("RRULE:").split(";"):
+        key, separator, value = part.partition("=")
+        if not separator or key in parts:
+            raise ValueError(f"Malformed RRULE part {part!r}")
+        parts[key] = value
+
+    freq = parts.pop("FREQ", None)
+    if freq not in ("DAILY", "WEEKLY", "MONTHLY"):
+        raise ValueError("FREQ must be DAILY, WEEKLY or MONTHLY")
+    interval = int(parts.pop("INTERVAL", "1"))
+    count = int(parts.pop("COUNT")) if "COUNT" in parts else None
+    until = _parse_until(parts.pop("UNTIL")) if "UNTIL" in parts else None
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError("INTERVAL and COUNT must be positive")
+    if interval > MAX_INTERVAL:
+        raise ValueError(f"INTERVAL can be at most {MAX_INTERVAL}")
+    if count is not None and count > MAX_COUNT:
+        raise ValueError(f"COUNT can be at most {MAX_COUNT}")
+    if count is not None and until is not None:
+        raise ValueError("COUNT and UNTIL cannot be combined")
+
+    byday: Tuple[int, ...] = ()
+    if "BYDAY" in parts:
+        if freq != "WEEKLY":
+            raise ValueError("BYDAY is only supported for WEEKLY rules")
+        days = parts.pop("BYDAY").split(",")
+        if not set(days) <= set(WEEKDAYS):
+            raise ValueError("BYDAY must list weekdays such as MO,WE,FR")
+        byday = tuple(sorted({WEEKDAYS.index(day) for day in days}))
+
+    if parts:
+        raise ValueError(f"Unsupported RRULE parts: {', '.join(sorted(parts))}")
+    return Rule(freq=freq, interval=interval, count=count, until=until, byday=byday)
+
+
+def _weekday(timestamp: int) -> int:
+    return (timestamp // DAY + 3) % 7  # 1970-01-01 was a Thursday
+
+
+def _fixed_period_starts(
+    start: int, period: int, after: int
+) -> Iterator[Tuple[int, int]]:
+    first = (after - start) // period + 1 if after >= start else 0
+    index = first
+    while True:
+        yield index, start + index * period
+        index += 1
+
+
+def _weekly_byday_starts(
+    start: int, rule: Rule, after: int
+) -> Iterator[Tuple[int, int]]:
+    period = rule.interval * WEEK
+    first_weekday = _weekday(start)
+    week_anchor = start - first_weekday * DAY
+    # Occurrences in the first week that fall before the series start don't exist,
+    # so later weeks are numbered after however many did
+    first_week = [day for day in rule.byday if day >= first_weekday]
+    per_week = len(rule.byday)
+
+    week = max(0, (after - week_anchor - 6 * DAY) // period)
+    while True:
+        days = first_week if week == 0 else rule.byday
+        offset = 0 if week == 0 else len(first_week) + (week - 1) * per_week
+        for position, day in enumerate(days):
+            yield offset + position, week_anchor + week * period + day * DAY
+        week += 1
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    """Days from 1970-01-01 to a date, for any year, where datetime stops at 9999."""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _monthly_starts(start: int, rule: Rule, after: int) -> Iterator[Tuple[int, int]]:
+    origin = datetime.fromtimestamp(start, timezone.utc)
+    origin_days = _days_from_civil(origin.year, origin.month, origin.day)
+    step = 0
+    if rule.count is None and after > start:
+        # Without COUNT the index is irrelevant, so jump straight to the window
+        after_date = datetime.fromtimestamp(after, timezone.utc)
+        months = (after_date.year - origin.year) * 12 + after_date.month - origin.month
+        step = max(0, months // rule.interval - 1)
+
+    index = 0
+    while True:
+        month = origin.month - 1 + step * rule.interval
+        year, month = origin.year + month // 12, month % 12 + 1
+        step += 1
+        # Months without the start's day of month are skipped, as in RFC 5545
+        month_length = calendar.mdays[month] + (month == 2 and calendar.isleap(year))
+        if origin.day <= month_length:
+            # Counted in days, so series that run on for millennia just end past
+            # TIME_RANGE rather than overflowing datetime
+            days = _days_from_civil(year, month, origin.day) - origin_days
+            yield index, start + days * DAY
+            index += 1
+
+
+def occurrences(
+    start: int,
+    end: int,
+    rule: Rule,
+    window_start: int | None = None,
+    window_end: int | None = None,
+) -> Iterator[Tuple[int, int]]:
+    """Lazily yield (start, end) of each occurrence overlapping the window.
+
+    The window is [window_start, window_end) with either side optionally open.
+    Skips directly to the window where the rule allows it instead of walking the
+    series from its beginning. Unbounded rules with no window_end never stop.
+    """
+    duration = end - start
+    # An occurrence overlaps the window if it starts after this point
+    after = (
+        start - 1 if window_start is None else max(start - 1, window_start - duration)
+    )
+
+    if rule.freq == "DAILY":
+        starts = _fixed_period_starts(start, rule.interval * DAY, after)
+    elif rule.freq == "WEEKLY" and not rule.byday:
+        starts = _fixed_period_starts(start, rule.interval * WEEK, after)
+    elif rule.freq == "WEEKLY":
+        starts = _weekly_byday_starts(start, rule, after)
+    else:
+        starts = _monthly_starts(start, rule, after)
+
+    for index, occurrence in starts:
+        if rule.count is not None and index >= rule.count:
+            return
+        if rule.until is not None and occurrence > rule.until:
+            return
+        if window_end is not None and occurrence >= window_end:
+            return
+        if occurrence > after:
+            yield occurrence, occurrence + duration
+
+
+def is_occurrence(start: int, end: int, recurrence: str, timestamp: int) -> bool:
+    """Whether an occurrence of the series starts exactly at timestamp."""
+    return any(
+        occurrence_start == timestamp
+        for occurrence_start, _ in occurrences(
+            start, end, parse_rule(recurrence), timestamp, timestamp + 1
+        )
+    )
+
+
+def series_end(start: int, end: int, recurrence: str | None) -> int | None:
+    """When the last occurrence of a series ends, or None if it repeats forever.
+
+    Series that run on past TIME_RANGE get some end beyond it, not the exact one.
+    """
+    if recurrence is None:
+        return end
+    rule = parse_rule(recurrence)
+    if not rule.bounded:
+        return None
+    if rule.freq == "DAILY" or not rule.byday and rule.freq == "WEEKLY":
+        # Occurrences are evenly spaced, so the last one is found without walking
+        period = rule.interval * (DAY if rule.freq == "DAILY" else WEEK)
+        if rule.count is not None:
+            last = rule.count - 1
+        else:
+            last = max(0, (rule.until - start) // period)
+        return end + last * period
+    last_end = end
+    for _, last_end in occurrences(start, end, rule):
+        if last_end >= TIME_RANGE.stop:
+            break
+    return last_end
@@ -1,16 +1,19 @@
 from datetime import datetime, timedelta
 from typing import Annotated
+from uuid import UUID
 
 from config.config import settings
-from database.database import DBSession, User
+from database.database import AsyncDBSession, User
+from database.pubsub import broker
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from models import UserData
-from passlib.context import CryptContext
 from pydantic import BaseModel
+from security.cache import user_cache
+from security.hashing import get_hash, verify_and_update
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 class Token(BaseModel):
@@ -25,28 +28,29 @@ CredentialsException = HTTPException(
 )
 
 
-hash_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-
-def validate(value: str, hashed_value: str) -> bool:
-    return hash_context.verify(secret=value, hash=hashed_value)
-
-
-def get_hash(value: str) -> str:
-    return hash_context.hash(value)
+IncorrectLoginException = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Username or password is incorrect",
+    headers={"WWW-Authenticate": "Bearer"},
+)
 
 
-def authenticate_user(username: str, password: str) -> UserData:
-    session: Session
-    with DBSession() as session:
-        user = session.scalar(select(User).where(User.username == username))
-        if not user or not validate(password, user.password_hash):
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Username or password is incorrect",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
+async def authenticate_user(username: str, password: str) -> UserData:
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        user = await session.scalar(select(User).where(User.username == username))
+        if not user:
+            raise IncorrectLoginException
+        valid, new_hash = await verify_and_update(password, user.password_hash)
+        if not valid:
+            raise IncorrectLoginException
+        if new_hash:
+            # Stored hash predates the current bcrypt settings, upgrade it now
+            user.password_hash = new_hash
+            await broker.publish_user_changes(session, [user.id])
+            await session.commit()
         return UserData(
             id=user.id,
             username=user.username,
@@ -64,24 +68,36 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> UserData:
-    user_id: str | None
+async def get_current_user_from_token(token: str) -> UserData:
+    """Like get_current_user, for clients that can only pass the token in the URL."""
+    return await get_current_user(token)
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> UserData:
+    user_id: UUID
     try:
         payload = jwt.decode(token, settings.pass_key, algorithms=["HS256"])
-        user_id = payload.get("sub")
-        if user_id is None:
+        subject = payload.get("sub")
+        if subject is None:
             raise CredentialsException
-    except JWTError:
+        user_id = UUID(subject)
+    except (JWTError, ValueError):
         raise CredentialsException
 
-    session: Session
-    with DBSession() as session:
-        user = session.scalar(select(User).where(User.id == user_id))
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        user = await session.scalar(select(User).where(User.id == user_id))
         if user is None:
             raise CredentialsException
-        return UserData(
+        user_data = UserData(
             id=user.id,
             username=user.username,
             password_hash=user.password_hash,
             email=user.email,
         )
+    user_cache.put(user_data)
+    return user_data
@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from itertools import chain
+from uuid import UUID
+
+from bloom import BloomFilter
+from config.config import settings
+from database.database import AsyncDBSession, User
+from models import UserData
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class UserCache:
+    """Bounded LRU cache of authenticated users with a per-entry TTL.
+
+    Entries are dropped when a user's record changes, on every worker through the
+    broker's user changes. With the local broker other worker processes aren't told,
+    and the TTL bounds how long they can serve a stale copy.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[UUID, tuple[float, UserData]] = OrderedDict()
+
+    def get(self, user_id: UUID) -> UserData | None:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: UserData) -> None:
+        self._entries[user.id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: UUID) -> None:
+        self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(max_size=settings.user_cache_size, ttl=settings.user_cache_ttl)
+
+
+def username_key(username: str) -> str:
+    return "username:" + username
+
+
+def email_key(email: str) -> str:
+    return "email:" + email
+
+
+# Every username and email in use, so that availability checks can skip the database
+# for names that are definitely free. Names given up by renames and deleted accounts
+# stay in until the next rebuild, which only costs their checks a query.
+taken_names = BloomFilter(settings.taken_names_capacity, settings.taken_names_error_rate)
+
+
+async def load_taken_names() -> None:
+    """Rebuild taken_names from the users table, leaving room for it to double."""
+    session: AsyncSession
+    async with AsyncDBSession() as session:
+        user_count = await session.scalar(select(func.count()).select_from(User))
+        # Emptied before the names are read: any announced by other workers from here
+        # on are kept, and those committed earlier are in the read
+        taken_names.reset(
+            max(settings.taken_names_capacity, 4 * user_count), settings.taken_names_error_rate
+        )
+        users = (await session.execute(select(User.username, User.email))).all()
+    taken_names.update(
+        chain.from_iterable((username_key(username), email_key(email)) for username, email in users)
+    )
@@ -0,0 +1,76 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config.config import settings
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+HashingBusyException = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many password operations in progress, try again shortly",
+    headers={"Retry-After": "1"},
+)
+
+
+hash_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.bcrypt_rounds
+)
+
+# Workers are started by a forkserver rather than forked from the app, whose event
+# loop, connection pools and threads a forked child would inherit in whatever state
+# they were in. The server imports this module once, so each worker starts ready.
+_context = multiprocessing.get_context("forkserver")
+_context.set_forkserver_preload([__name__])
+_pool: ProcessPoolExecutor | None = None
+_in_flight = 0
+
+
+def _hash(value: str) -> str:
+    return hash_context.hash(value)
+
+
+def _verify_and_update(value: str, hashed_value: str) -> tuple[bool, str | None]:
+    return hash_context.verify_and_update(value, hashed_value)
+
+
+async def _submit(func, *args):
+    """Run a bcrypt call in the hashing pool, refusing work once the queue is full."""
+    global _pool, _in_flight
+    if _in_flight >= settings.hash_workers + settings.hash_queue_depth:
+        raise HashingBusyException
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.hash_workers, mp_context=_context
+        )
+
+    pool = _pool
+    _in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died, e.g. killed for memory, and the pool refuses all work from
+        # then on. Replace it on the next call, unless a caller already has.
+        if _pool is pool:
+            _pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HashingBusyException
+    finally:
+        _in_flight -= 1
+
+
+async def get_hash(value: str) -> str:
+    return await _submit(_hash, value)
+
+
+async def verify_and_update(value: str, hashed_value: str) -> tuple[bool, str | None]:
+    """Check a password; also returns a new hash if the stored one is outdated."""
+    return await _submit(_verify_and_update, value, hashed_value)
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
@@ -208,6 +208,17 @@ function App() {
     getUserInfo();
   }, []);
 
+  // Refresh whenever the server reports that someone changed one of our events
+  useEffect(() => {
+    if (!isLoggedIn) {
+      return;
+    }
+    const token = encodeURIComponent(localStorage.getItem("daydreamers-access-token"));
+    const source = new EventSource(`/api/event/stream?token=${token}`);
+    source.addEventListener("calendar", () => fetchEvents());
+    return () => source.close();
+  }, [isLoggedIn]);
+
 
   const handleAddEvent = (title, description, startTime, endTime) => {
     const newEvent = {
@@ -277,6 +288,7 @@ function App() {
         'Authorization': "Bearer " + localStorage.getItem("daydreamers-access-token")
       },
       body: JSON.stringify({
+        event_id: event.event_id,
         start: moment(start).unix(),
         stop: moment(end).unix(),
         title: event.title,
@@ -355,7 +367,7 @@ function App() {
         'Content-Type': 'application/json',
         'Authorization': "Bearer " + localStorage.getItem("daydreamers-access-token")
       },
-      body: JSON.stringify({ title, description, start, end })
+      body: JSON.stringify({ event_id: selectedEvent.event_id, title, description, start, end })
     })
     if (response.ok) {
       fetchEvents();